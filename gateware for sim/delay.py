@@ -15,7 +15,7 @@
 
 # Delayer temporarily moved out of the sequencing module to break a circular dependency
 
-from amaranth import Signal
+from amaranth import Cat, Signal
 
 from amaranth_cfu import SimpleElaboratable
 
@@ -25,37 +25,38 @@ class Delayer(SimpleElaboratable):
 
     Parameters
     ----------
-    cycles: int
-        Number of cycles to delay the signal
+    fixed_cycles: int
+        Number of cycles to delay the signal, if known at build time. The
+        shift register is then exactly that long and the cycles input is
+        ignored. When None, the delay is chosen at run time by cycles.
 
     Public Interface
     ---------------
+    cycles: Signal(4) in
+        Number of cycles to delay the signal, from 1 to 5
     input: Signal() in
         The input signal
     output: Signal() out
         Mirrors the input signal after cycles delay
     """
 
-    def __init__(self):
+    def __init__(self, fixed_cycles=None):
+        assert fixed_cycles is None or fixed_cycles >= 1, fixed_cycles
+        self.fixed_cycles = fixed_cycles
         self.cycles = Signal(4)
         self.input = Signal()
         self.output = Signal()
 
     def elab(self, m):
-        shift_register = Signal(6)
-
-        with m.If(self.cycles==5):
-            m.d.comb += self.output.eq(shift_register[4])
-        with m.Elif(self.cycles==4):
-            m.d.comb += self.output.eq(shift_register[3])
-        with m.Elif(self.cycles==3):
-            m.d.comb += self.output.eq(shift_register[2])  
-        with m.Elif(self.cycles==2):
-            m.d.comb += self.output.eq(shift_register[1])            
-        with m.Else():
-            m.d.comb += self.output.eq(shift_register[0])
-        
-        m.d.sync += [
-            shift_register[1:].eq(shift_register),
-            shift_register[0].eq(self.input),
-        ]
+        length = self.fixed_cycles if self.fixed_cycles is not None else 5
+        shift_register = Signal(length)
+        m.d.sync += shift_register.eq(Cat(self.input, shift_register[:-1]))
+
+        if self.fixed_cycles is not None:
+            m.d.comb += self.output.eq(shift_register[-1])
+            return
+
+        # Tap n is the input delayed by n cycles. Tap 0 repeats tap 1, as
+        # a zero cycle delay is not supported.
+        taps = Cat(shift_register[0], shift_register)
+        m.d.comb += self.output.eq(taps.bit_select(self.cycles, 1))
@@ -13,18 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from amaranth import Cat, Signal, signed
+from amaranth import Cat, Mux, Signal, signed
 
-from amaranth_cfu import all_words, SimpleElaboratable, tree_sum
+from amaranth_cfu import SimpleElaboratable, tree_sum
 
 
 # from .delay import Delayer
 # from .post_process import PostProcessor
 # from .registerfile import Xetter
+# from .winograd import A_T, block_lane, weighted_sum
 
 from delay import Delayer
 from post_process import PostProcessor
 from registerfile import Xetter
+from winograd import A_T, block_lane, weighted_sum
 
 
 class Mul8Pipeline(SimpleElaboratable):
@@ -45,8 +47,9 @@ class Mul8Pipeline(SimpleElaboratable):
         8 bytes of filter data to use next
     i_data: Signal(32) input
         8 bytes of input data data to use next
-    result: Signal(signed(32)) output
-        Result of the multiply and add
+    products: Signal(24 * 16) output
+        Sixteen signed 24 bit products, one per lane. Use product(n) to
+        read a single lane.
     """
     PIPELINE_CYCLES_P = 3  # 1 for x,1 for add in acc
     PIPELINE_CYCLES_D = 1
@@ -59,125 +62,107 @@ class Mul8Pipeline(SimpleElaboratable):
         self.switch_PorD = Signal()
         # self.result = Signal(signed(32))
         # self.products = [Signal(signed(17), name=f"product_{n}") for n in range(4)]
-        self.products = [Signal(signed(24)) for n in range(16)]
-
-    def elab(self, m):
-
-        # Product is 17 bits: 8 bits * 9 bits = 17 bits
-        # products = [Signal(signed(17), name=f"product_{n}") for n in range(4)]
-
-        for i_val, f_val, product in zip(
-                all_words(self.i_data, 12), all_words(self.f_data, 12), self.products):
+        self.products = Signal(24 * 16)
 
-            f_tmp = Signal(signed(12))
-            m.d.sync += f_tmp.eq(f_val.as_signed())
-            i_tmp = Signal(signed(12))
+    def product(self, n):
+        """Signed product for lane n"""
+        return self.products.word_select(n, 24).as_signed()
 
-            m.d.sync += i_tmp.eq(i_val.as_signed())
-            m.d.comb += product.eq(i_tmp * f_tmp)
-
-        # m.d.sync += self.result.eq(tree_sum(self.products))
+    def elab(self, m):
+        # Register all 16 lanes of each operand with a single assignment,
+        # then multiply lane by lane
+        f_tmps = [Signal(signed(12), name=f"f_tmp_{n}") for n in range(16)]
+        i_tmps = [Signal(signed(12), name=f"i_tmp_{n}") for n in range(16)]
+        m.d.sync += [
+            Cat(*f_tmps).eq(self.f_data),
+            Cat(*i_tmps).eq(self.i_data),
+        ]
+        m.d.comb += [self.products.word_select(n, 24).eq(i_tmp * f_tmp)
+                     for n, (i_tmp, f_tmp) in enumerate(zip(i_tmps, f_tmps))]
 
 
 class AccOrTrans(SimpleElaboratable):
     """An accumulator for a Mul8Pipline
 
+    In depthwise mode this is instead the Winograd output transform,
+    A^T.M.A. It is pipelined as two stages of three operand sums, so
+    results are available PIPELINE_CYCLES_D cycles after in_values.
+
+    Parameters
+    ----------
+    mode: str
+        Which convolutions to build hardware for: 'pointwise', 'depthwise'
+        or 'both'. Logic for the other kind is left out, so switch_PorD
+        must select the built mode.
+
     Public Interface
     ----------------
     add_en: Signal() input
         When to add the input
-    in_value: Signal(signed(32)) input
-        The input data to add
+    in_values: Signal(24 * 16) input
+        Sixteen signed 24 bit products. Use in_value(n) to read a single lane.
     clear: Signal() input
         Zero accumulator.
     result: Signal(signed(32)) output
         Result of the multiply and add
     """
+    PIPELINE_CYCLES_D = 2  # M.A, then A^T.(M.A)
 
-    def __init__(self):
+    def __init__(self, mode='both'):
         super().__init__()
+        assert mode in ('pointwise', 'depthwise', 'both'), mode
+        self.mode = mode
         self.add_en = Signal()
-        self.in_values = [Signal(signed(24)) for n in range(16)]
+        self.in_values = Signal(24 * 16)
         self.switch_PorD = Signal()
         self.clear = Signal()
         self.result = [Signal(signed(32), reset=0x0,
                               name=f"result_{n}") for n in range(4)]
 
+    def in_value(self, n):
+        """Signed input value for lane n"""
+        return self.in_values.word_select(n, 24).as_signed()
+
     def elab(self, m):
         with m.If(self.switch_PorD == 0):
-            # for pointwise
-            add_sum = Signal(signed(28))
-            m.d.sync += add_sum.eq(tree_sum(self.in_values[n]
-                                   for n in range(8)))
-            accumulator = Signal(signed(32))
-            # m.d.comb += self.result.eq(accumulator)
-            with m.If(self.add_en):
-                m.d.sync += accumulator.eq(accumulator + add_sum)
-                m.d.comb += self.result[0].eq(accumulator + add_sum)
-            with m.Else():
-                m.d.comb += self.result[0].eq(accumulator)
-            # clear always resets accumulator next cycle, even if add_en is high
-            # late_clear=Signal()
-            # m.d.sync+=late_clear.eq(self.clear)
-            with m.If(self.clear):
-                m.d.sync += accumulator.eq(0)
+            if self.mode != 'depthwise':
+                # for pointwise
+                add_sum = Signal(signed(28))
+                m.d.sync += add_sum.eq(tree_sum(self.in_value(n)
+                                       for n in range(8)))
+                accumulator = Signal(signed(32))
+                # m.d.comb += self.result.eq(accumulator)
+                with m.If(self.add_en):
+                    m.d.sync += accumulator.eq(accumulator + add_sum)
+                    m.d.comb += self.result[0].eq(accumulator + add_sum)
+                with m.Else():
+                    m.d.comb += self.result[0].eq(accumulator)
+                # clear always resets accumulator next cycle, even if add_en is high
+                # late_clear=Signal()
+                # m.d.sync+=late_clear.eq(self.clear)
+                with m.If(self.clear):
+                    m.d.sync += accumulator.eq(0)
 
         with m.Else():
-            # for depthwise
-            # clear always resets accumulator next cycle, even if add_en is high
-            # late_clear=Signal()
-            # m.d.sync+=late_clear.eq(self.clear)
-            Y = [Signal(signed(32), reset=0x0,
-                        name=f"Y_{n}") for n in range(4)]
-            Y_tmp = [Signal(signed(32), reset=0x0,
-                            name=f"Y_tmp_{n}") for n in range(4)]
-            
-            late_in_values=[Signal(signed(24), reset=0x0,
-                            name=f"late_in_values_{n}") for n in range(4)]
-            m.d.sync += [late_in_values[0].eq(self.in_values[12]),
-                         late_in_values[1].eq(self.in_values[13]),
-                         late_in_values[2].eq(self.in_values[14]),
-                         late_in_values[3].eq(self.in_values[15]),
-
-
-
-            ]
-            # A = Signal(signed(32))
-            # b = Signal(signed(32))
-            # m.d.sync += A.eq(0xFFFFF008)
-            # m.d.sync +=b.eq(A>>2)
-
-            m.d.sync += Y_tmp[0].eq(tree_sum(iter([self.in_values[0], self.in_values[2], self.in_values[8], self.in_values[1],
-                                    self.in_values[3], self.in_values[9], self.in_values[4],
-                                    self.in_values[6]])))
-            m.d.sync += Y_tmp[1].eq(tree_sum(iter([self.in_values[1], self.in_values[3], self.in_values[9], -self.in_values[4],
-                                    -self.in_values[6], -self.in_values[12], -self.in_values[5], -
-                                    self.in_values[7]])))
-            m.d.sync += Y_tmp[2].eq(tree_sum(iter([self.in_values[2], -self.in_values[8], -self.in_values[10], self.in_values[3],
-                                    -self.in_values[9], - self.in_values[11], self.in_values[6], -
-                                    self.in_values[12]])))
-            m.d.sync += Y_tmp[3].eq(tree_sum(iter([self.in_values[3], -self.in_values[9], -self.in_values[11], -self.in_values[6],
-                                    self.in_values[12], self.in_values[14], -
-                                                   self.in_values[7],
-                                    self.in_values[13]])))
-
-            m.d.sync += Y[0].eq((Y_tmp[0]+late_in_values[0]) )
-            m.d.sync += Y[1].eq((Y_tmp[1]-late_in_values[1]) )
-            m.d.sync += Y[2].eq((Y_tmp[2]-late_in_values[2]) )
-            m.d.sync += Y[3].eq((Y_tmp[3]+late_in_values[3]) )
-
-            # m.d.sync += Y[0].eq((self.in_values[0]+self.in_values[1]+self.in_values[2]+self.in_values[3] +
-            #                               self.in_values[4]+self.in_values[6]+self.in_values[8]+self.in_values[9]+self.in_values[12])>>2)
-            # m.d.sync += Y[1].eq((self.in_values[1]+self.in_values[3]-self.in_values[4]-self.in_values[5] -
-            #                               self.in_values[6]-self.in_values[7]+self.in_values[9]-self.in_values[12]-self.in_values[13])>>2)
-            # m.d.sync += Y[2].eq((self.in_values[2]+self.in_values[3]+self.in_values[6]-self.in_values[8] -
-            #                               self.in_values[9]-self.in_values[10]-self.in_values[11]-self.in_values[12]-self.in_values[14])>>2)
-            # m.d.sync += Y[3].eq((self.in_values[3]-self.in_values[6]-self.in_values[7]-self.in_values[9] -
-            #                               self.in_values[11]+self.in_values[12]+self.in_values[13]+self.in_values[14]+self.in_values[15])>>2)
-            m.d.comb += self.result[0].eq(Y[0]>>2)
-            m.d.comb += self.result[1].eq(Y[1]>>2)
-            m.d.comb += self.result[2].eq(Y[2]>>2)
-            m.d.comb += self.result[3].eq(Y[3]>>2)
+            if self.mode != 'pointwise':
+                # for depthwise
+                Y = [Signal(signed(32), reset=0x0,
+                            name=f"Y_{n}") for n in range(4)]
+                mat = [[self.in_value(block_lane(r, c)) for c in range(4)]
+                       for r in range(4)]
+                row = [[Signal(signed(26), name=f"row_{r}_{n}") for n in range(2)]
+                       for r in range(4)]
+                m.d.sync += (
+                    # First half of the output transform, M.A, one row at a time
+                    [row[r][n].eq(weighted_sum(A_T[n], mat[r]))
+                     for r in range(4) for n in range(2)] +
+                    # Second half, A^T.(M.A)
+                    [Y[2*i + j].eq(weighted_sum(A_T[i], [row[r][j] for r in range(4)]))
+                     for i in range(2) for j in range(2)])
+
+                # Divide by 4 by dropping the two low bits of each output
+                m.d.comb += [self.result[n].eq(Y[n][2:].as_signed())
+                             for n in range(4)]
 
 
 class ByteToWordShifter(SimpleElaboratable):
@@ -205,12 +190,8 @@ class ByteToWordShifter(SimpleElaboratable):
 
     def elab(self, m):
         register = Signal(32)
-        m.d.comb += self.result.eq(register)
+        shifted = Cat(register[8:], self.in_value)
+        m.d.comb += self.result.eq(Mux(self.shift_en, shifted, register))
 
         with m.If(self.shift_en):
-            calc = Signal(32)
-            m.d.comb += [
-                calc.eq(Cat(register[8:], self.in_value)),
-                self.result.eq(calc),
-            ]
-            m.d.sync += register.eq(calc)
+            m.d.sync += register.eq(shifted)
@@ -13,19 +13,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from amaranth import Signal, Mux
+from amaranth import Cat, Signal, Mux
 
 from amaranth_cfu import SimpleElaboratable
 
 
 # from . import config
 # from .delay import Delayer
-# from .mul import Mul8Pipeline
+# from .mul import AccOrTrans, Mul8Pipeline
 # from .post_process import PostProcessor
 
 import config
 from delay import Delayer
-from mul import Mul8Pipeline
+from mul import AccOrTrans, Mul8Pipeline
 from post_process import PostProcessor
 
 
@@ -59,12 +59,16 @@ class UpCounter(SimpleElaboratable):
 
     def elab(self, m):
         count = Signal.like(self.max)
-        last_count = self.max - 1
-        next_count = Mux(count == last_count, 0, count + 1)
+        # Compare the incremented count with max, rather than count with
+        # max - 1, so a single adder serves both the increment and the test
+        incremented = count + 1
+        at_last = Signal()
+        m.d.comb += at_last.eq(incremented == self.max)
+        next_count = Mux(at_last, 0, incremented)
 
         with m.If(self.en):
             m.d.sync += count.eq(next_count)
-            m.d.comb += self.done.eq(count == last_count)
+            m.d.comb += self.done.eq(at_last)
 
         with m.If(self.restart):
             m.d.sync += count.eq(0)
@@ -113,6 +117,14 @@ class Sequencer(SimpleElaboratable):
     This is the control logic required to calculate all output channel values
     for a single input pixel.
 
+    Parameters
+    ----------
+    mode: str
+        Which convolutions to sequence: 'pointwise', 'depthwise' or 'both'.
+        With a single mode, the logic for the other mode is left out, and
+        switch_PorD must be tied to the built mode, as Mnv2RegisterInstruction
+        does for every block of the CFU.
+
     Public Interface
     ---------------
     start_run: Signal() in
@@ -140,9 +152,18 @@ class Sequencer(SimpleElaboratable):
     out_word_done: Signal() out
         Four output channel values have been calculated into the output word which is
         ready to be put onto the FIFO.
+    filter_next: Signal() out
+        Advance to the next filter values. In pointwise mode this is gate. In
+        depthwise mode it is registered, one cycle after the last gate of the run.
     """
 
-    def __init__(self):
+    # Cycles for FilterValueFetcher to fetch and transform a depthwise filter.
+    # Kept here because the store module imports this one.
+    FETCH_CYCLES_D = 2
+
+    def __init__(self, mode='both'):
+        assert mode in ('pointwise', 'depthwise', 'both'), mode
+        self.mode = mode
         self.start_run = Signal()
         self.in_store_ready = Signal()
         self.fifo_has_space = Signal()
@@ -161,8 +182,14 @@ class Sequencer(SimpleElaboratable):
         self.switch_PorD=Signal()
         self.num_tile = Signal(16)
         self.filter_next=Signal()
-        
 
+    def _by_mode(self, depthwise, pointwise):
+        """Selects the value for the current mode"""
+        if self.mode == 'pointwise':
+            return pointwise
+        if self.mode == 'depthwise':
+            return depthwise
+        return Mux(self.switch_PorD, depthwise, pointwise)
 
     def elab(self, m):
         m.submodules['gate_calc'] = gate_calc = GateCalculator()
@@ -174,82 +201,80 @@ class Sequencer(SimpleElaboratable):
             self.gate.eq(gate_calc.gate),
         ]
 
-        m.submodules['fnext_count'] = fnext_count = UpCounter(
-            self.num_tile.shape().width)
-        m.d.comb += [
-            fnext_count.restart.eq(self.restart),
-            fnext_count.en.eq(self.gate),
-            fnext_count.max.eq(self.num_tile),
-        ]
-
-
-        with m.If(self.switch_PorD==0):
-            m.d.comb += self.filter_next.eq(self.gate)
-        with m.Else():
-            m.d.comb += self.filter_next.eq(fnext_count.done)
-
-        m.submodules['f_count'] = f_count = UpCounter(
-            self.filter_value_words.shape().width)
-        with m.If(self.switch_PorD==0):
-            m.d.comb +=f_count.max.eq(self.filter_value_words[1:])
-        with m.Else():
-            m.d.comb +=f_count.max.eq(self.num_tile)
+        # Restart is registered once for the counters below, so they load a
+        # local copy rather than the shared restart net. Filter values are
+        # always stored after a restart, so no run starts in the cycle it
+        # is delayed by.
+        restart = Signal()
+        m.d.sync += restart.eq(self.restart)
+
+        # In depthwise mode a run is num_tile tiles of a single filter, so
+        # the count that finishes the run also moves on to the next filter.
+        # Nothing reads the filter again until the next run starts, so that
+        # advance is registered to keep the counter compare off its path.
+        # Word counts are halved by slicing, so each counter is only as wide
+        # as the max it is given in this mode
+        f_max = self._by_mode(self.num_tile, self.filter_value_words[1:])
+        m.submodules['f_count'] = f_count = UpCounter(len(f_max))
         m.d.comb += [
-            f_count.restart.eq(self.restart),
+            f_count.max.eq(f_max),
+            f_count.restart.eq(restart),
             f_count.en.eq(self.gate),
-            self.all_output_finished.eq(f_count.done)
+            self.all_output_finished.eq(f_count.done),
         ]
+        filter_done = Signal()
+        m.d.sync += filter_done.eq(f_count.done)
+        m.d.comb += self.filter_next.eq(self._by_mode(filter_done, self.gate))
 
 
-        m.submodules['i_count'] = i_count = UpCounter(
-            self.input_depth_words.shape().width)
+        i_max = self._by_mode(self.num_tile, self.input_depth_words[1:])
+        m.submodules['i_count'] = i_count = UpCounter(len(i_max))
         
         m.d.comb +=[
-            i_count.restart.eq(self.restart),
+            i_count.max.eq(i_max),
+            i_count.restart.eq(restart),
             self.acc_done.eq(i_count.done)]
-        with m.If(self.switch_PorD==0):
-            m.d.comb += i_count.max.eq(self.input_depth_words[1:])
-        with m.Else():
-            m.d.comb += i_count.max.eq(self.num_tile)
-
-        m.submodules['four_count'] = four_count = UpCounter(3)
-        m.d.comb += [
-            four_count.max.eq(4),
-            four_count.restart.eq(self.restart),
-        ]
-
-        m.submodules['mul_delay'] = mul_delay = Delayer()
-        
-        #edit function Delayer. edit function Delayer. edit function Delayer.
-        with m.If(self.switch_PorD==0):
-            m.d.comb +=mul_delay.cycles.eq(3)
-        with m.Else():
-            m.d.comb+=mul_delay.cycles.eq(5)#fetch+madd+trans. now Mul8Pipeline.PIPELINE_CYCLES_D=Mul8Pipeline.PIPELINE_CYCLES_P-1
-
 
+        # Depthwise delay covers filter fetch and transform, multiply, and
+        # output transform
+        mul_cycles_d = (self.FETCH_CYCLES_D + Mul8Pipeline.PIPELINE_CYCLES_D
+                        + AccOrTrans.PIPELINE_CYCLES_D)
+        if self.mode == 'both':
+            m.submodules['mul_delay'] = mul_delay = Delayer()
+            m.d.comb += mul_delay.cycles.eq(
+                Mux(self.switch_PorD, mul_cycles_d, Mul8Pipeline.PIPELINE_CYCLES_P))
+        else:
+            m.submodules['mul_delay'] = mul_delay = Delayer(
+                self._by_mode(mul_cycles_d, Mul8Pipeline.PIPELINE_CYCLES_P))
         m.d.comb += [
             mul_delay.input.eq(self.gate),
             self.mul_done.eq(mul_delay.output),
             i_count.en.eq(mul_delay.output),
         ]
 
-        m.submodules['pp_delay'] = pp_delay = Delayer()
-        m.d.comb +=pp_delay.cycles.eq(PostProcessor.PIPELINE_CYCLES)
+        m.submodules['pp_delay'] = pp_delay = Delayer(PostProcessor.PIPELINE_CYCLES)
         m.d.comb += [
             pp_delay.input.eq(self.acc_done),
             self.pp_done.eq(pp_delay.output),
-            four_count.en.eq(pp_delay.output),
         ]
 
-#edit function Delayer. edit function Delayer. edit function Delayer.
-        m.submodules['depth2_delay'] = depth2_delay = Delayer()
-        m.d.comb += depth2_delay.cycles.eq(PostProcessor.PIPELINE_CYCLES)
-        m.d.comb += depth2_delay.input.eq(self.mul_done)
-
-        with m.If(self.switch_PorD==0):
-            m.d.comb +=self.out_word_done.eq(four_count.done)
-        with m.Else():
-            m.d.comb +=self.out_word_done.eq(depth2_delay.output)
+        # Pointwise output words hold four post processed values, while
+        # depthwise words are ready a fixed time after the multiply
+        four_done = depth2_done = None
+        if self.mode != 'depthwise':
+            # A one hot ring counts the fixed four values without a comparator
+            four_ring = Signal(4, reset=1)
+            with m.If(pp_delay.output):
+                m.d.sync += four_ring.eq(Cat(four_ring[3], four_ring[:3]))
+            with m.If(restart):
+                m.d.sync += four_ring.eq(four_ring.reset)
+            four_done = four_ring[3] & pp_delay.output
+        if self.mode != 'pointwise':
+            m.submodules['depth2_delay'] = depth2_delay = Delayer(
+                PostProcessor.PIPELINE_CYCLES)
+            m.d.comb += depth2_delay.input.eq(self.mul_done)
+            depth2_done = depth2_delay.output
+        m.d.comb += self.out_word_done.eq(self._by_mode(depth2_done, four_done))
 
 
 
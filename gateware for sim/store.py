@@ -13,15 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from amaranth import Array, Signal, Mux, Cat, signed
+from amaranth import Array, Signal, Mux, Cat, Const, signed
 
-from amaranth_cfu import SimpleElaboratable, is_pysim_run, DualPortMemory, SequentialMemoryReader, tree_sum
+from amaranth_cfu import SimpleElaboratable, is_pysim_run, DualPortMemory, SequentialMemoryReader
 
 # from .registerfile import Xetter
 # from .sequencing import UpCounter
+# from .winograd import B_T, G, block_lane, weighted_sum
 
 from registerfile import Xetter
 from sequencing import UpCounter
+from winograd import B_T, G, block_lane, weighted_sum
 
 
 class StoreSetter(Xetter):
@@ -82,18 +84,30 @@ class StoreSetter(Xetter):
         return statement_list
 
     def elab(self, m):
+        # Any start writes to exactly one memory
         m.d.comb += [
             self.done.eq(True),
             self.w_addr.eq(self.count[self.num_memories_bits:]),
-            self.updated.eq(Cat(self.w_en).any() | self.restart),
+            self.updated.eq(self.start | self.restart),
         ]
+        if len(self.w_en) == 1:
+            with m.If(self.restart):
+                m.d.sync += self.count.eq(0)
+            with m.Elif(self.start):
+                m.d.comb += [
+                    self.w_en[0].eq(1),
+                    self.w_data.eq(self.in0),
+                ]
+                m.d.sync += self.count.eq(self.count + 1)
+            return
+
+        one_hot = Signal(len(self.w_en))
+        m.d.comb += one_hot.eq(Const(1, len(self.w_en)) << self.count[:self.num_memories_bits])
         with m.If(self.restart):
             m.d.sync += self.count.eq(0)
         with m.Elif(self.start):
-            m.d.comb += [
-                self.w_en[self.count[:self.num_memories_bits]].eq(1),
-                self.w_data.eq(self.in0),
-            ]
+            m.d.comb += [w_en.eq(one_hot[n]) for n, w_en in enumerate(self.w_en)]
+            m.d.comb += self.w_data.eq(self.in0)
             m.d.sync += self.count.eq(self.count + 1)
 
 
@@ -144,10 +158,20 @@ class CircularIncrementer(SimpleElaboratable):
 class FilterValueFetcher(SimpleElaboratable):
     """Fetches next single word from a 4-way filter value store.
 
+    In depthwise mode each fetch is a 3x3 filter, which is Winograd
+    transformed into sixteen lanes with a latency of two cycles. A new
+    filter may be requested every cycle (when there is a single tile per
+    channel), so all sixteen lanes are computed in parallel.
+
     Parameters
     ----------
     max_depth:
         Maximum number of items stored in each memory
+    mode: str
+        Which convolutions to build hardware for: 'pointwise', 'depthwise'
+        or 'both'. Pointwise only builds leave out the filter transform and
+        read each pair of memories through a single double width reader.
+        In a single mode build, switch_PorD must select the built mode.
 
     Public Interface
     ----------------
@@ -167,9 +191,11 @@ class FilterValueFetcher(SimpleElaboratable):
         Soft reset signal to restart all processing
     """
 
-    def __init__(self, max_depth):
+    def __init__(self, max_depth, mode='both'):
         super().__init__()
+        assert mode in ('pointwise', 'depthwise', 'both'), mode
         self.max_depth = max_depth
+        self.mode = mode
         self.limit = Signal(range(max_depth * 4))
         self.mem_addrs = [
             Signal(
@@ -181,12 +207,18 @@ class FilterValueFetcher(SimpleElaboratable):
         self.updated = Signal()
         self.restart = Signal()
         self.switch_PorD = Signal()
-        
 
-        self.smrs = [
-            SequentialMemoryReader(
-                width=32,
-                max_depth=max_depth) for _ in range(4)]
+        # Pointwise fetches always read memories 0 and 1 or memories 2 and 3
+        if mode == 'pointwise':
+            self.smrs = [
+                SequentialMemoryReader(
+                    width=64,
+                    max_depth=max_depth) for _ in range(2)]
+        else:
+            self.smrs = [
+                SequentialMemoryReader(
+                    width=32,
+                    max_depth=max_depth) for _ in range(4)]
 
     def connect_read_ports(self, dual_port_memories):
         """Helper method to connect a list of dual port memories to self.
@@ -202,140 +234,127 @@ class FilterValueFetcher(SimpleElaboratable):
             ]
         return result
 
+    def _elab_paired(self, m):
+        """Pointwise only fetching, with one reader per pair of memories"""
+        was_updated = Signal()
+        m.d.sync += was_updated.eq(self.updated)
+        smr_datas = Array([Signal(64, name=f"smr_data_{n}") for n in range(2)])
+        smr_nexts = Signal(2)
+        for n, (smr, smr_data) in enumerate(zip(self.smrs, smr_datas)):
+            m.submodules[f"smr_{n}"] = smr
+            m.d.comb += [
+                smr.limit.eq((self.limit + 3 - 2 * n) >> 2),
+                self.mem_addrs[2 * n].eq(smr.mem_addr),
+                self.mem_addrs[2 * n + 1].eq(smr.mem_addr),
+                smr.mem_data.eq(Cat(self.mem_datas[2 * n], self.mem_datas[2 * n + 1])),
+                smr_data.eq(smr.data),
+                smr.next.eq(smr_nexts[n]),
+                smr.restart.eq(was_updated),
+            ]
+
+        r_addr = Signal.like(self.limit)
+        tmp = Signal(64)
+        m.d.comb += tmp.eq(smr_datas[r_addr[1]])
+        m.d.sync += [self.data.word_select(n, 12).eq(tmp.word_select(n, 8).as_signed())
+                     for n in range(8)]
+
+        last_addr = Signal.like(self.limit)
+        m.d.comb += last_addr.eq(self.limit - 2)
+        with m.If(self.restart):
+            m.d.sync += r_addr.eq(0)
+        with m.Elif(self.next):
+            m.d.comb += smr_nexts.eq(Mux(r_addr[1], 0b10, 0b01))
+            with m.If(r_addr == last_addr):
+                m.d.sync += r_addr.eq(0)
+            with m.Else():
+                m.d.sync += r_addr.eq(r_addr + 2)
+
     def elab(self, m):
+        if self.mode == 'pointwise':
+            self._elab_paired(m)
+            return
+
         was_updated = Signal()
         m.d.sync += was_updated.eq(self.updated)
         # Connect sequential memory readers
-        smr_datas = Array([Signal(32, name=f"smr_data_{n}") for n in range(4)])
-        smr_nexts = Array([Signal(name=f"smr_next_{n}") for n in range(4)])
-        for n, (smr, mem_addr, mem_data, smr_data, smr_next) in enumerate(
-                zip(self.smrs, self.mem_addrs, self.mem_datas, smr_datas, smr_nexts)):
+        smr_datas = [Signal(32, name=f"smr_data_{n}") for n in range(4)]
+        smr_nexts = Signal(4)
+        for n, (smr, mem_addr, mem_data, smr_data) in enumerate(
+                zip(self.smrs, self.mem_addrs, self.mem_datas, smr_datas)):
             m.submodules[f"smr_{n}"] = smr
             m.d.comb += [
                 smr.limit.eq((self.limit + 3 - n) >> 2),
                 mem_addr.eq(smr.mem_addr),
                 smr.mem_data.eq(mem_data),
                 smr_data.eq(smr.data),
-                smr.next.eq(smr_next),
+                smr.next.eq(smr_nexts[n]),
                 smr.restart.eq(was_updated),
             ]
 
 # add addr
 
         r_addr = Signal.like(self.limit)
-        # curr_bank = Signal(2)
-        # m.d.sync += self.data.eq(Cat(smr_datas[r_addr[:2]], smr_datas[r_addr[:2]+1],
-        #                          smr_datas[r_addr[:2]+2], smr_datas[r_addr[:2]+3]))
-        
-        tmp = Signal(128)
-        data_tmp=[Signal(signed(12), name=f"data_tmp_{n}") for n in range(16)]
-        late_tmp=[Signal(signed(8), name=f"late_tmp_{n}") for n in range(4)]
-        m.d.comb += tmp.eq(Cat(smr_datas[r_addr[:2]], smr_datas[(r_addr+1)[:2]],
-                           smr_datas[(r_addr+2)[:2]]))
-        def cut(l, no, width):
-                return l[no*width:(no+1)*width]
+
+        # Rotate the bank words so that bank r_addr[:2] comes first, and keep
+        # the three a fetch can use
+        tmp = Signal(96)
+        smr_datas_twice = Cat(*smr_datas * 2)
+        m.d.comb += tmp.eq(smr_datas_twice.bit_select(r_addr[:2] * 32, 96))
+
         with m.If(self.switch_PorD == 0):
-            m.d.sync += [cut(self.data, n, 12).eq((cut(tmp, n, 8).as_signed())) for n in range(8)
-                         ]
+            if self.mode != 'depthwise':
+                m.d.sync += [self.data.word_select(n, 12).eq((tmp.word_select(n, 8).as_signed())) for n in range(8)
+                             ]
         with m.Else():
-            m.d.sync += [data_tmp[0].eq((cut(tmp, 0, 8).as_signed())<<2),
-                         data_tmp[1].eq(tree_sum(iter([cut(tmp, 0, 8).as_signed(),cut(tmp, 1, 8).as_signed(),cut(tmp, 2, 8).as_signed()]))),
-                         data_tmp[2].eq(tree_sum(iter([cut(tmp, 0, 8).as_signed(),cut(tmp, 3, 8).as_signed(),cut(tmp, 6, 8).as_signed()]))),
-                         data_tmp[3].eq((tree_sum(iter([cut(tmp, 0, 8).as_signed(),cut(tmp, 3, 8).as_signed(),cut(tmp, 6, 8).as_signed(),cut(tmp, 1, 8).as_signed(),cut(tmp, 4, 8).as_signed()]))).as_signed()),
-                         data_tmp[4].eq(tree_sum(iter([cut(tmp, 0, 8).as_signed(),-cut(tmp, 1, 8).as_signed(),cut(tmp, 2, 8).as_signed()]))),
-                         data_tmp[5].eq((cut(tmp, 2, 8).as_signed())<<2),
-                         data_tmp[6].eq((tree_sum(iter([cut(tmp, 0, 8).as_signed(),cut(tmp, 3, 8).as_signed(),cut(tmp, 6, 8).as_signed(),-cut(tmp, 1, 8).as_signed(),-cut(tmp, 4, 8).as_signed()]))).as_signed()),
-                         data_tmp[7].eq(tree_sum(iter([cut(tmp, 2, 8).as_signed(),cut(tmp, 5, 8).as_signed(),cut(tmp, 8, 8).as_signed()]))),
-                         data_tmp[8].eq(tree_sum(iter([cut(tmp, 0, 8).as_signed(),-cut(tmp, 3, 8).as_signed(),cut(tmp, 6, 8).as_signed()]))),
-                         data_tmp[9].eq((tree_sum(iter([cut(tmp, 0, 8).as_signed(),-cut(tmp, 3, 8).as_signed(),cut(tmp, 6, 8).as_signed(),cut(tmp, 1, 8).as_signed(),-cut(tmp, 4, 8).as_signed()]))).as_signed()),
-                         data_tmp[10].eq((cut(tmp, 6, 8).as_signed())<<2),
-                         data_tmp[11].eq(tree_sum(iter([cut(tmp, 6, 8).as_signed(),cut(tmp, 7, 8).as_signed(),cut(tmp, 8, 8).as_signed()]))),
-                         data_tmp[12].eq((tree_sum(iter([cut(tmp, 0, 8).as_signed(),-cut(tmp, 3, 8).as_signed(),cut(tmp, 6, 8).as_signed(),-cut(tmp, 1, 8).as_signed(),cut(tmp, 4, 8).as_signed()]))).as_signed()),
-                         data_tmp[13].eq(tree_sum(iter([cut(tmp, 2, 8).as_signed(),-cut(tmp, 5, 8).as_signed(),cut(tmp, 8, 8).as_signed()]))),
-                         data_tmp[14].eq(tree_sum(iter([cut(tmp, 6, 8).as_signed(),-cut(tmp, 7, 8).as_signed(),cut(tmp, 8, 8).as_signed()]))),
-                         data_tmp[15].eq((cut(tmp, 8, 8).as_signed())<<2),
-                
-                        
-
-                
-                         
-                         late_tmp[0].eq(cut(tmp, 7, 8).as_signed()),
-                         late_tmp[1].eq(cut(tmp, 2, 8).as_signed()),
-                         late_tmp[2].eq(cut(tmp, 5, 8).as_signed()),
-                         late_tmp[3].eq(cut(tmp, 8, 8).as_signed()),
-
-
-                         cut(self.data, 0, 12).eq(data_tmp[0]),
-                         cut(self.data, 1, 12).eq((data_tmp[1]) << 1),
-                         cut(self.data, 2, 12).eq((data_tmp[2]) << 1),
-                         cut(self.data, 3, 12).eq((tree_sum(iter(
-                             [data_tmp[3], late_tmp[0], late_tmp[1], late_tmp[2], late_tmp[3]]))).as_signed()),
-                         cut(self.data, 4, 12).eq((data_tmp[4]) << 1),
-                         cut(self.data, 5, 12).eq(data_tmp[5]),
-                         cut(self.data, 6, 12).eq((tree_sum(iter(
-                             [data_tmp[6], -late_tmp[0], late_tmp[1], late_tmp[2], late_tmp[3]]))).as_signed()),
-                         cut(self.data, 7, 12).eq(data_tmp[7] << 1),
-                         cut(self.data, 8, 12).eq(data_tmp[8] << 1),
-                         cut(self.data, 9, 12).eq((tree_sum(iter(
-                             [data_tmp[9], late_tmp[0], late_tmp[1], -late_tmp[2], late_tmp[3]]))).as_signed()),
-                         cut(self.data, 10, 12).eq(data_tmp[10]),
-                         cut(self.data, 11, 12).eq(data_tmp[11] << 1),
-                         cut(self.data, 12, 12).eq((tree_sum(iter(
-                             [data_tmp[12], -late_tmp[0], late_tmp[1], -late_tmp[2], late_tmp[3]]))).as_signed()),
-                         cut(self.data, 13, 12).eq(data_tmp[13] << 1),
-                         cut(self.data, 14, 12).eq(data_tmp[14] << 1),
-                         cut(self.data, 15, 12).eq(data_tmp[15]),
-                        ]
-
-            # m.d.sync += [cut(self.data, 0, 12).eq((cut(tmp, 0, 8).as_signed()).as_signed()<<2),
-            #              cut(self.data, 1, 12).eq((cut(tmp, 0, 8).as_signed()+cut(tmp, 1, 8).as_signed()+cut(tmp, 2, 8).as_signed()).as_signed()<<1),
-            #              cut(self.data, 2, 12).eq((cut(tmp, 0, 8).as_signed()+cut(tmp, 3, 8).as_signed()+cut(tmp, 6, 8).as_signed()).as_signed()<<1),
-            #              cut(self.data, 3, 12).eq((cut(tmp, 0, 8).as_signed()+cut(tmp, 3, 8).as_signed()+cut(tmp, 6, 8).as_signed()+cut(tmp, 1, 8).as_signed()+cut(tmp, 4, 8).as_signed()+cut(tmp, 7, 8).as_signed()+cut(tmp, 2, 8).as_signed()+cut(tmp, 5, 8).as_signed()+cut(tmp, 8, 8).as_signed()).as_signed()),
-            #              cut(self.data, 4, 12).eq((cut(tmp, 0, 8).as_signed()-cut(tmp, 1, 8).as_signed()+cut(tmp, 2, 8).as_signed()).as_signed()<<1),
-            #              cut(self.data, 5, 12).eq((cut(tmp, 2, 8).as_signed()).as_signed()<<2),
-            #              cut(self.data, 6, 12).eq((cut(tmp, 0, 8).as_signed()+cut(tmp, 3, 8).as_signed()+cut(tmp, 6, 8).as_signed()-cut(tmp, 1, 8).as_signed()-cut(tmp, 4, 8).as_signed()-cut(tmp, 7, 8).as_signed()+cut(tmp, 2, 8).as_signed()+cut(tmp, 5, 8).as_signed()+cut(tmp, 8, 8).as_signed()).as_signed()),
-            #              cut(self.data, 7, 12).eq((cut(tmp, 2, 8).as_signed()+cut(tmp, 5, 8).as_signed()+cut(tmp, 8, 8).as_signed()).as_signed()<<1),
-            #              cut(self.data, 8, 12).eq((cut(tmp, 0, 8).as_signed()-cut(tmp, 3, 8).as_signed()+cut(tmp, 6, 8).as_signed()).as_signed()<<1),
-            #              cut(self.data, 9, 12).eq((cut(tmp, 0, 8).as_signed()-cut(tmp, 3, 8).as_signed()+cut(tmp, 6, 8).as_signed()+cut(tmp, 1, 8).as_signed()-cut(tmp, 4, 8).as_signed()+cut(tmp, 7, 8).as_signed()+cut(tmp, 2, 8).as_signed()-cut(tmp, 5, 8).as_signed()+cut(tmp, 8, 8).as_signed()).as_signed()),
-            #              cut(self.data, 10, 12).eq((cut(tmp, 6, 8).as_signed()).as_signed()<<2),
-            #              cut(self.data, 11, 12).eq((cut(tmp, 6, 8).as_signed()+cut(tmp, 7, 8).as_signed()+cut(tmp, 8, 8).as_signed()).as_signed()<<1),
-            #              cut(self.data, 12, 12).eq((cut(tmp, 0, 8).as_signed()-cut(tmp, 3, 8).as_signed()+cut(tmp, 6, 8).as_signed()-cut(tmp, 1, 8).as_signed()+cut(tmp, 4, 8).as_signed()-cut(tmp, 7, 8).as_signed()+cut(tmp, 2, 8).as_signed()-cut(tmp, 5, 8).as_signed()+cut(tmp, 8, 8).as_signed()).as_signed()),
-            #              cut(self.data, 13, 12).eq((cut(tmp, 2, 8).as_signed()-cut(tmp, 5, 8).as_signed()+cut(tmp, 8, 8).as_signed()).as_signed()<<1),
-            #              cut(self.data, 14, 12).eq((cut(tmp, 6, 8).as_signed()-cut(tmp, 7, 8).as_signed()+cut(tmp, 8, 8).as_signed()).as_signed()<<1),
-            #              cut(self.data, 15, 12).eq((cut(tmp, 8, 8).as_signed()).as_signed()<<2),
-            #              ]
-            
-        # a=Signal(12)
-        # b = [Signal(8) for n in range(4)]
-        # m.d.comb+=[b[0].eq(cut(tmp, 2, 8)),
-        # b[1].eq(cut(tmp, 2, 8)),
-        # b[2].eq(cut(tmp, 5, 8)),
-        # b[3].eq(cut(tmp, 13, 8))]
-        # m.d.sync +=a.eq(b[0].as_signed()<<2)
-        # c=Signal(12)
-        # d=Signal(8)
-        # m.d.sync +=c.eq((cut(tmp, 1, 8).as_signed()).as_signed()<<2)
-        # m.d.sync +=d.eq(-b[1].as_signed())
-
+            if self.mode != 'pointwise':
+                # The nine taps of a 3x3 filter, in row major order, registered
+                # straight off the memory read mux
+                t = [Signal(signed(8), name=f"t_{n}") for n in range(9)]
+                m.d.sync += [t[n].eq(tmp.word_select(n, 8).as_signed()) for n in range(9)]
+                g = [t[3*r:3*r + 3] for r in range(3)]
+
+                # First half of the filter transform, G.g
+                gg = [[Signal(signed(10), name=f"gg_{r}_{c}") for c in range(3)]
+                      for r in range(4)]
+                m.d.comb += [gg[r][c].eq(weighted_sum(G[r], [g[k][c] for k in range(3)]))
+                             for r in range(4) for c in range(3)]
+                # Second half, (G.g).G^T
+                m.d.sync += [self.data.word_select(block_lane(r, c), 12).eq(weighted_sum(G[c], gg[r]))
+                             for r in range(4) for c in range(4)]
+
+        # Memories to advance for each bank in r_addr[:2]. A pointwise fetch
+        # reads two consecutive banks and a depthwise fetch reads three.
+        def next_masks(num_banks):
+            return Array(Const(sum(1 << ((b + n) & 3) for n in range(num_banks)), 4)
+                         for b in range(4))
+        next_masks_p = next_masks(2)
+        next_masks_d = next_masks(3)
+
+        # Address of the last fetch before r_addr wraps. limit changes with
+        # every filter value stored, so these follow it combinationally.
+        last_addr_p = Signal.like(self.limit)
+        last_addr_d = Signal.like(self.limit)
+        m.d.comb += [
+            last_addr_p.eq(self.limit - 2),
+            last_addr_d.eq(self.limit - 3),
+        ]
+        wrap = Signal()
+        m.d.comb += wrap.eq(r_addr == Mux(self.switch_PorD, last_addr_d, last_addr_p))
 
         with m.If(self.restart):
             m.d.sync += r_addr.eq(0)
         with m.Elif(self.next):
             with m.If(self.switch_PorD == 0):
-                m.d.comb += smr_nexts[r_addr[:2]].eq(1)
-                m.d.comb += smr_nexts[r_addr[:2]+1].eq(1)
+                m.d.comb += smr_nexts.eq(next_masks_p[r_addr[:2]])
 
-                with m.If(r_addr == self.limit - 2):
+                with m.If(wrap):
                     m.d.sync += r_addr.eq(0)
                 with m.Else():
                     m.d.sync += r_addr.eq(r_addr + 2)
             with m.Else():
-                m.d.comb += smr_nexts[r_addr[:2]].eq(1)
-                m.d.comb += smr_nexts[(r_addr+1)[:2]].eq(1)
-                m.d.comb += smr_nexts[(r_addr+2)[:2]].eq(1)
-                # m.d.comb += smr_nexts[r_addr[:2]+3].eq(1)
+                m.d.comb += smr_nexts.eq(next_masks_d[r_addr[:2]])
 
-                with m.If(r_addr == self.limit - 3):
+                with m.If(wrap):
                     m.d.sync += r_addr.eq(0)
                 with m.Else():
                     m.d.sync += r_addr.eq(r_addr + 3)
@@ -398,6 +417,10 @@ class InputStore(SimpleElaboratable):
     max_depth: int
         maximum allowed input depth.
         Assumed to be power of two.
+    mode: str
+        Which convolutions to build hardware for: 'pointwise', 'depthwise'
+        or 'both'. The input transform is left out of pointwise only builds.
+        In a single mode build, switch_PorD must select the built mode.
 
     Public Interface
     ----------------
@@ -416,17 +439,24 @@ class InputStore(SimpleElaboratable):
 
     r_ready: Signal() output
         Indicates that data has been stored and reading is allowed
-    r_data: Signal(32) output
-        Four words of data
+    r_data: Signal(192) output
+        Sixteen 12 bit lanes of data. In pointwise mode the first eight
+        lanes are input bytes plus offset, registered once. In depthwise
+        mode they are the Winograd transformed tile, two registered
+        stages on: the transform, with the input offset correction
+        (4 * offset, in tile element (1, 1)), is registered into
+        r_data_tmp, which is then registered into r_data.
     r_next: Signal() input
         Data being read this cycle, so advance data pointer by one word next cycle
     r_finished: Signal() input
         Last data read this cycle, so move to next buffer on next cycle
     """
 
-    def __init__(self, max_depth):
+    def __init__(self, max_depth, mode='both'):
         super().__init__()
+        assert mode in ('pointwise', 'depthwise', 'both'), mode
         self.max_depth = max_depth
+        self.mode = mode
         self.restart = Signal()
         self.input_depth = Signal(range(max_depth * 4 // 2))
         self.w_data = Signal(32)
@@ -458,7 +488,7 @@ class InputStore(SimpleElaboratable):
                 max_depth=self.max_depth // 2,
                 width=32) for _ in range(4)]
         smr_nexts = Array(smr.next for smr in smrs)
-        mem_addrs =Array(Signal(range(self.max_depth // 2),  name=f"mem_addrs_{n}") for n in range(4))
+        mem_addrs = [Signal(range(self.max_depth // 2), name=f"mem_addrs_{n}") for n in range(4)]
         for (n, dp, smr,mem_addr) in zip(range(4), dps, smrs,mem_addrs):
             m.submodules[f"smr_{n}"] = smr
             m.d.comb += [
@@ -467,10 +497,15 @@ class InputStore(SimpleElaboratable):
                 smr.mem_data.eq(dp.r_data),
                 smr.limit.eq((self.input_depth + 3 - n) >> 2),
             ]
-            with m.If(self.switch_PorD == 0):
-                m.d.comb +=dp.r_addr.eq(Cat(smr.mem_addr, r_curr_buf))
-            with m.Else():
-                m.d.comb +=dp.r_addr.eq(Cat(mem_addr, r_curr_buf))
+            # Pointwise reads are sequential, so each memory follows its
+            # reader. Depthwise reads use the bank addresses below.
+            if self.mode == 'pointwise':
+                bank_addr = smr.mem_addr
+            elif self.mode == 'depthwise':
+                bank_addr = mem_addr
+            else:
+                bank_addr = Mux(self.switch_PorD, mem_addr, smr.mem_addr)
+            m.d.comb += dp.r_addr.eq(Cat(bank_addr, r_curr_buf))
 
 
 
@@ -494,9 +529,13 @@ class InputStore(SimpleElaboratable):
         # Increment address
         # edit r_addr
 
+        # Address of the last pointwise read
+        end_read = Signal.like(self.input_depth)
+        m.d.comb += end_read.eq(self.input_depth - 2)
+
         with m.If(self.r_next & self.r_ready):
             with m.If(self.switch_PorD == 0):
-                with m.If(r_addr == self.input_depth - 2):
+                with m.If(r_addr == end_read):
                     m.d.sync += r_addr.eq(0)
                 with m.Else():
                     m.d.sync += r_addr.eq(r_addr + 2)
@@ -509,154 +548,99 @@ class InputStore(SimpleElaboratable):
                 with m.Else():
                     m.d.sync += r_addr.eq(r_addr + self.pad+2)
 
-                m.d.comb += mem_addrs[(r_addr[:2])].eq((r_addr[2:]))
-                m.d.comb += mem_addrs[((r_addr+1)[:2])].eq(((r_addr+1)[2:]))
-                m.d.comb += mem_addrs[((r_addr+self.input_width+self.pad)[:2])].eq(((r_addr+self.input_width+self.pad)[2:]))
-                m.d.comb += mem_addrs[((r_addr+self.input_width+self.pad+1)[:2])].eq(((r_addr+self.input_width+self.pad+1)[2:]))
-        with m.Else():
-            m.d.comb += mem_addrs[0].eq(0)
-            m.d.comb += mem_addrs[1].eq(0)
-            m.d.comb += mem_addrs[2].eq(((self.input_width+self.pad)[2:]))
-            m.d.comb += mem_addrs[3].eq(((self.input_width+self.pad+1)[2:]))
-
-
-
-  
+        if self.mode != 'pointwise':
+            # A depthwise read takes the words at base, base + 1, base + stride
+            # and base + stride + 1, where stride = input_width + pad. pad is
+            # chosen to make stride 2 mod 4, so the four words are in different
+            # banks: bank n holds word k = (n - base) & 3, one row further on if
+            # the bank number wrapped, and stride // 4 rows further for k >= 2.
+            # input_width (register 37) and pad, which is derived from it, are
+            # written before any depthwise read starts, so stride // 4 is
+            # registered to keep their adder off the address path.
+            # When input_width is fixed at build time it is a constant.
+            base = Signal.like(r_addr)
+            m.d.comb += base.eq(Mux(self.r_next & self.r_ready, r_addr, 0))
+            stride_rows = Signal.like(mem_addrs[0])
+            m.d.sync += stride_rows.eq((self.input_width + self.pad)[2:])
+            # The row offset by stride is shared by all four banks
+            base_row = base[2:]
+            next_row = Signal.like(mem_addrs[0])
+            m.d.comb += next_row.eq(base_row + stride_rows)
+            for n, mem_addr in enumerate(mem_addrs):
+                k = Signal(2, name=f"mem_word_{n}")
+                m.d.comb += [
+                    k.eq(n - base[:2]),
+                    mem_addr.eq(Mux(k[1], next_row, base_row) + (n < base[:2])),
+                ]
 
         # Get data
-        smr_datas = Array(smr.data for smr in smrs)
-        smr_mem_datas = Array(smr.mem_data for smr in smrs)
-
-        # tmp = Signal(128)
-        # r_data_tmp=[Signal(signed(12), name=f"data_tmp_{n}") for n in range(16)]
-        # m.d.comb += tmp.eq(Cat(smr_datas[r_addr[:2]], smr_datas[r_addr[:2]+1],
-        #                    smr_datas[r_addr[:2]+2], smr_datas[r_addr[:2]+3]))
-        
-
-
         tmp = Signal(128)
 
-        tmp1 = Signal(128)
-
-        tmp2 = Signal(128)
-        r_data_tmp=[Signal(signed(12), name=f"data_tmp_{n}") for n in range(16)]
-
-        # m.d.comb += tmp1.eq(Cat(smr_datas[r_addr[:2]], smr_datas[r_addr[:2]+1],
-        #                    smr_datas[r_addr[:2]+2], smr_datas[r_addr[:2]+3]))
-        # m.d.comb += tmp2.eq(Cat(smr_mem_datas[(r_addr-1)[:2]], smr_mem_datas[(r_addr)[:2]],
-        #                    smr_mem_datas[(r_addr+1)[:2]], smr_mem_datas[(r_addr+2)[:2]]))
-        # with m.If(r_addr[:2]==0):
-        #     m.d.comb += tmp1.eq(Cat(smr_datas[0], smr_datas[1]))
-        # with m.Elif(r_addr[:2]==2):
-        #     m.d.comb += tmp1.eq(Cat(smr_datas[2], smr_datas[3]))
-        smr_no_p=Signal(2)
-        m.d.comb+=smr_no_p.eq(r_addr[:2])
-        with m.If(smr_no_p==0):
-            m.d.comb += tmp1.eq(Cat(smr_datas[0], smr_datas[1]))
-        with m.Elif(smr_no_p==2):
-            m.d.comb += tmp1.eq(Cat(smr_datas[2], smr_datas[3]))
-
-        smr_no_d=Signal(2)
-        with m.If(self.r_next & self.r_ready):
-            m.d.sync+=smr_no_d.eq(r_addr[:2])
-        with m.Else():
-            m.d.sync+=smr_no_d.eq(0)
-
-        with m.If(smr_no_d==0):
-            m.d.comb += tmp2.eq(Cat(smr_mem_datas[0], smr_mem_datas[1],
-                           smr_mem_datas[2], smr_mem_datas[3]))            
-        with m.Elif(smr_no_d==1):
-            m.d.comb += tmp2.eq(Cat(smr_mem_datas[1], smr_mem_datas[2],
-                           smr_mem_datas[3], smr_mem_datas[0]))
-        with m.Elif(smr_no_d==2):
-            m.d.comb += tmp2.eq(Cat(smr_mem_datas[2], smr_mem_datas[3],
-                           smr_mem_datas[0], smr_mem_datas[1]))
-        with m.Elif(smr_no_d==3):
-            m.d.comb += tmp2.eq(Cat(smr_mem_datas[3], smr_mem_datas[0],
-                           smr_mem_datas[1], smr_mem_datas[2]))
-        # with m.If(r_addr[:2]==0):
-        #     m.d.comb += tmp1.eq(Cat(smr_datas[0], smr_datas[1]))
-        #     m.d.comb += tmp2.eq(Cat(smr_mem_datas[3], smr_mem_datas[0],
-        #                    smr_mem_datas[1], smr_mem_datas[2]))
-        # with m.Elif(r_addr[:2]==1):
-        #     m.d.comb += tmp2.eq(Cat(smr_mem_datas[0], smr_mem_datas[1],
-        #                    smr_mem_datas[2], smr_mem_datas[3]))
-        # with m.Elif(r_addr[:2]==2):
-        #     m.d.comb += tmp1.eq(Cat(smr_datas[2], smr_datas[3]))
-        #     m.d.comb += tmp2.eq(Cat(smr_mem_datas[1], smr_mem_datas[2],
-        #                    smr_mem_datas[3], smr_mem_datas[0]))
-        # with m.Elif(r_addr[:2]==3):
-        #     m.d.comb += tmp2.eq(Cat(smr_mem_datas[2], smr_mem_datas[3],
-        #                    smr_mem_datas[0], smr_mem_datas[1]))
+        if self.mode != 'depthwise':
+            # Pointwise reads advance two banks at a time, so r_addr[:2] is
+            # always 0 or 2 and a single bit picks the pair. Only the two
+            # words of the pair are kept; tmp zero extends them.
+            smr_datas = [smr.data for smr in smrs]
+            tmp1 = Signal(64)
+            m.d.comb += tmp1.eq(Mux(r_addr[1], Cat(smr_datas[2], smr_datas[3]),
+                                    Cat(smr_datas[0], smr_datas[1])))
+
+        if self.mode != 'pointwise':
+            # Memory read data arrives the cycle after its address, so the
+            # first bank of the read is registered to line up with it
+            smr_no_d = Signal(2)
+            with m.If(self.r_next & self.r_ready):
+                m.d.sync += smr_no_d.eq(r_addr[:2])
+            with m.Else():
+                m.d.sync += smr_no_d.eq(0)
 
+            # Rotate the four memory words so that bank smr_no_d comes first
+            tmp2 = Signal(128)
+            mem_datas_twice = Cat(*[smr.mem_data for smr in smrs] * 2)
+            m.d.comb += tmp2.eq(mem_datas_twice.bit_select(smr_no_d * 32, 128))
 
-        with m.If(self.switch_PorD == 0):
+        if self.mode == 'pointwise':
             m.d.comb += tmp.eq(tmp1)
-        with m.Else():
+        elif self.mode == 'depthwise':
             m.d.comb += tmp.eq(tmp2)
+        else:
+            m.d.comb += tmp.eq(Mux(self.switch_PorD, tmp2, tmp1))
 
-        # m.d.comb += tmp1.eq(Cat(smr_datas[0], smr_datas[1],
-        #                    smr_datas[2], smr_datas[3]))
-        # m.d.comb += tmp2.eq(Cat(smr_mem_datas[0], smr_mem_datas[1],
-        #                    smr_mem_datas[2], smr_mem_datas[3]))
-        # with m.If(self.switch_PorD == 0):
-        #     m.d.comb += tmp.eq(tmp1>>((r_addr[1:2])*32))
-        # with m.Else():
-        #     m.d.comb += tmp.eq(tmp2>>(((r_addr-1)[:2])*32))
-
-        
-
+        with m.If(self.switch_PorD == 0):
+            if self.mode != 'depthwise':
+                # Only the first eight lanes are used by a pointwise multiply
+                lanes = [(tmp.word_select(n, 8).as_signed() + self.offset)[:12]
+                         for n in range(8)]
+                m.d.sync += self.r_data[:12 * 8].eq(Cat(*lanes))
+        with m.Else():
+            if self.mode != 'pointwise':
+                r_data_tmp = [Signal(signed(12), name=f"data_tmp_{n}") for n in range(16)]
 
-        def cut(l, no, width,offset=0):
-                return l[no*width:(no+1)*width]
-        
+                # Signed input bytes, in 2x2 block order
+                t = [Signal(signed(8), name=f"t_{n}") for n in range(16)]
+                m.d.comb += [t[n].eq(tmp.word_select(n, 8).as_signed()) for n in range(16)]
 
+                d = [[t[block_lane(r, c)] for c in range(4)] for r in range(4)]
 
+                # Row transform, d.B. Each sum is shared between the output lanes
+                # of its column.
+                row_t = [[Signal(signed(9), name=f"row_t_{r}_{c}") for c in range(4)]
+                         for r in range(4)]
+                m.d.comb += [row_t[r][c].eq(weighted_sum(B_T[c], d[r]))
+                             for r in range(4) for c in range(4)]
 
-        with m.If(self.switch_PorD == 0):
-            m.d.sync += [cut(self.r_data, n, 12).eq((cut(tmp, n, 8).as_signed())+self.offset) for n in range(8)
-                         ]
-        with m.Else():
+                # Column transform, B^T.(d.B). Element (1, 1) is the only one
+                # whose coefficients do not sum to zero, so adding the input
+                # offset to every byte adds 4 * offset there and nothing
+                # elsewhere. It is summed in here, alongside the other terms.
+                for i in range(4):
+                    for c in range(4):
+                        v = weighted_sum(B_T[i], [row_t[r][c] for r in range(4)])
+                        if (i, c) == (1, 1):
+                            v = v + (self.offset << 2)
+                        m.d.sync += r_data_tmp[block_lane(i, c)].eq(v)
 
-            m.d.sync += [
-                         r_data_tmp[0].eq((tree_sum(iter([cut(tmp, 0, 8).as_signed(),-cut(tmp, 8, 8).as_signed()-cut(tmp, 4, 8).as_signed(),cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[1].eq((tree_sum(iter([cut(tmp, 1, 8).as_signed(),-cut(tmp, 9, 8).as_signed(),cut(tmp, 4, 8).as_signed(),-cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[2].eq((tree_sum(iter([ cut(tmp, 2, 8).as_signed(),cut(tmp, 8, 8).as_signed()-cut(tmp, 6, 8).as_signed(),-cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[3].eq((tree_sum(iter([cut(tmp, 3, 8).as_signed(),cut(tmp, 9, 8).as_signed(),cut(tmp, 6, 8).as_signed(),cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[4].eq((tree_sum(iter([-cut(tmp, 1, 8).as_signed(),cut(tmp, 9, 8).as_signed(),cut(tmp, 4, 8).as_signed(),-cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[5].eq((tree_sum(iter([cut(tmp, 1, 8).as_signed(),-cut(tmp, 9, 8).as_signed(),-cut(tmp, 5, 8).as_signed(),cut(tmp, 13, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[6].eq((tree_sum(iter([-cut(tmp, 3, 8).as_signed(),-cut(tmp,9, 8).as_signed(),cut(tmp, 6, 8).as_signed(),cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[7].eq((tree_sum(iter([cut(tmp, 3, 8).as_signed(),cut(tmp, 9, 8).as_signed(),-cut(tmp, 7, 8).as_signed(),-cut(tmp, 13, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[8].eq((tree_sum(iter([-cut(tmp, 2, 8).as_signed(),cut(tmp, 8, 8).as_signed(),cut(tmp, 6, 8).as_signed(),-cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[9].eq((tree_sum(iter([-cut(tmp, 3, 8).as_signed(),cut(tmp,9, 8).as_signed(),-cut(tmp, 6, 8).as_signed(),cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[10].eq((tree_sum(iter([cut(tmp, 2, 8).as_signed(),-cut(tmp, 10, 8).as_signed(),-cut(tmp, 6, 8).as_signed(),cut(tmp, 14, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[11].eq((tree_sum(iter([cut(tmp, 3, 8).as_signed(),-cut(tmp, 11, 8).as_signed(),cut(tmp, 6, 8).as_signed(),-cut(tmp, 14, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[12].eq((tree_sum(iter([cut(tmp, 3, 8).as_signed(),-cut(tmp, 9, 8).as_signed(),-cut(tmp, 6, 8).as_signed(),cut(tmp, 12, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[13].eq((tree_sum(iter([-cut(tmp, 3, 8).as_signed(),cut(tmp,9, 8).as_signed(),cut(tmp, 7, 8).as_signed(),-cut(tmp, 13, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[14].eq((tree_sum(iter([-cut(tmp, 3, 8).as_signed(),cut(tmp,11, 8).as_signed(),cut(tmp, 6, 8).as_signed(),-cut(tmp, 14, 8).as_signed()]))).as_signed()),
-                         r_data_tmp[15].eq((tree_sum(iter([cut(tmp, 3, 8).as_signed(),-cut(tmp, 11, 8).as_signed(),-cut(tmp, 7, 8).as_signed(),cut(tmp, 15, 8).as_signed()]))).as_signed()),
-                
-                
-
-
-                         cut(self.r_data, 0, 12).eq(r_data_tmp[0]),
-                         cut(self.r_data, 1, 12).eq(r_data_tmp[1]),
-                         cut(self.r_data, 2, 12).eq(r_data_tmp[2]),
-                         cut(self.r_data, 3, 12).eq((tree_sum(iter([ r_data_tmp[3],(self.offset<<2)]))).as_signed()),
-                         cut(self.r_data, 4, 12).eq(r_data_tmp[4]),
-                         cut(self.r_data, 5, 12).eq(r_data_tmp[5]),
-                         cut(self.r_data, 6, 12).eq(r_data_tmp[6]),
-                         cut(self.r_data, 7, 12).eq(r_data_tmp[7]),
-                         cut(self.r_data, 8, 12).eq(r_data_tmp[8]),
-                         cut(self.r_data, 9, 12).eq(r_data_tmp[9]),
-                         cut(self.r_data, 10, 12).eq(r_data_tmp[10]),
-                         cut(self.r_data, 11, 12).eq(r_data_tmp[11]),
-                         cut(self.r_data, 12, 12).eq(r_data_tmp[12]),
-                         cut(self.r_data, 13, 12).eq(r_data_tmp[13]),
-                         cut(self.r_data, 14, 12).eq(r_data_tmp[14]),
-                         cut(self.r_data, 15, 12).eq(r_data_tmp[15]),
-                         
-                         ]
+                m.d.sync += self.r_data.eq(Cat(*r_data_tmp))
 
 
         # On finished (overrides r_next)
@@ -694,9 +678,13 @@ class InputStore(SimpleElaboratable):
         # Ready to write current buffer if reading is not allowed
         m.d.comb += self.w_ready.eq(~r_full[w_curr_buf])
 
+        # Address of the last write
+        end_write = Signal.like(self.input_depth)
+        m.d.comb += end_write.eq(self.input_depth - 1)
+
         # Write address increment
         with m.If(self.w_en & self.w_ready):
-            with m.If(w_addr == self.input_depth - 1):
+            with m.If(w_addr == end_write):
                 # at end of buffer - mark buffer ready for reading and go to
                 # next
                 m.d.sync += [
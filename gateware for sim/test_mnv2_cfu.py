@@ -20,11 +20,14 @@ from amaranth.build import Platform
 from amaranth.hdl.ast import Cat
 from amaranth.sim import Simulator
 
+import functools
 import unittest
 
 from mnv2_cfu import make_cfu
 
 
+# The tests pack the same few words many times over
+@functools.lru_cache(maxsize=None)
 def pack_vals(*values, offset=0, bits=8):
     """Packs single values into a word in little endian order.
     offset is added to the values before packing
@@ -37,6 +40,29 @@ def pack_vals(*values, offset=0, bits=8):
     return result
 
 
+# (bias, multiplier, shift) of each group of four output channels in the
+# pointwise tests
+POINTWISE_CHANNEL_PARAMS = (
+    (30_000, 31_000_000, -3),
+    (50_000, 50_000_000, -6),
+    (75_000, 56_000_000, -4),
+    (100_000, 50_000_000, -5),
+)
+
+# Register writes that load the pointwise tests' output channel params for
+# 24 channels, and their 96 filter words. Every pointwise run loads the same
+# values, so the ops are built once.
+POINTWISE_PARAM_OPS = tuple(
+    ((0, reg, val, 0), 0)
+    for _ in range(6)
+    for bias, mult, shift in POINTWISE_CHANNEL_PARAMS
+    for reg, val in ((21, mult), (22, shift), (23, bias)))
+POINTWISE_FILTER_OPS = tuple(
+    ((0, 24, pack_vals(*f_vals), 0), 0)
+    for f_vals in zip(range(-17, 79), range(3, 99),
+                      range(-50, 46), range(5, 101)))
+
+
 class SimpleElaboratable(Elaboratable):
     """Simplified Elaboratable interface
     Widely, but not generally applicable. Suitable for use with
@@ -80,12 +106,17 @@ class TestBase(unittest.TestCase):
     The module can use sync, comb or both.
     """
 
+    # Set when the DUT is known to contain synchronous logic, so no
+    # placeholder needs to be simulated alongside it
+    has_sync_logic = False
+
     def setUp(self):
         # Create DUT and add to simulator
         self.m = Module()
         self.dut = self.create_dut()
         self.m.submodules['dut'] = self.dut
-        self.m.submodules['placeholder'] = _PlaceholderSyncModule()
+        if not self.has_sync_logic:
+            self.m.submodules['placeholder'] = _PlaceholderSyncModule()
         self.sim = Simulator(self.m)
 
     def create_dut(self):
@@ -117,6 +148,8 @@ class TestBase(unittest.TestCase):
 class CfuTestBase(TestBase):
     """Tests CFU ops independent of timing and handshaking."""
 
+    has_sync_logic = True
+
     def _unpack(self, inputs):
         return inputs if len(inputs) == 4 else (
             inputs[0], 0, inputs[1], inputs[2])
@@ -156,8 +189,10 @@ class CfuTestBase(TestBase):
                     #                  f"function_id={function_id}, funct7={funct7}, " +
                     #                  f" in0={in0} {hex(in0)}, in1={in1} {hex(in1)} (n={n})")
                 yield
-            for n in range(20):
-                yield
+            # Idle cycles only show the tail of a run in the trace
+            if write_trace:
+                for n in range(20):
+                    yield
         self.run_sim(process, write_trace)
 
 
@@ -263,14 +298,6 @@ class CfuTest(CfuTestBase):
         def set_reg(reg, val):
             return ((0, reg, val, 0), 0)
 
-        def set_out_channel_params(bias, mult, shift):
-            yield set_reg(21, mult)
-            yield set_reg(22, shift)
-            yield set_reg(23, bias)
-
-        def set_filter_val(val):
-            return ((0, 24, val, 0), 0)
-
         def set_input_val(val):
             return ((0, 25, val, 0), 0)
 
@@ -293,15 +320,8 @@ class CfuTest(CfuTestBase):
             yield set_reg(14, -128)
             yield set_reg(15, 127)
 
-            for _ in range(6):
-                yield from set_out_channel_params(30_000, 31_000_000, -3)
-                yield from set_out_channel_params(50_000, 50_000_000, -6)
-                yield from set_out_channel_params(75_000, 56_000_000, -4)
-                yield from set_out_channel_params(100_000, 50_000_000, -5)
-
-            for f_vals in zip(nums(-17, 96), nums(3, 96),
-                              nums(-50, 96), nums(5, 96)):
-                yield set_filter_val(pack_vals(*f_vals))
+            yield from POINTWISE_PARAM_OPS
+            yield from POINTWISE_FILTER_OPS
 
             for i_vals in zip(nums(1, 4), nums(3, 4), nums(5, 4), nums(7, 4)):
                 yield set_input_val(pack_vals(*i_vals))
@@ -376,15 +396,8 @@ class CfuTest(CfuTestBase):
             yield set_reg(15, 127)
             yield set_reg(20, 24)
 
-            for _ in range(6):
-                yield from set_out_channel_params(30_000, 31_000_000, -3)
-                yield from set_out_channel_params(50_000, 50_000_000, -6)
-                yield from set_out_channel_params(75_000, 56_000_000, -4)
-                yield from set_out_channel_params(100_000, 50_000_000, -5)
-
-            for f_vals in zip(nums(-17, 96), nums(3, 96),
-                              nums(-50, 96), nums(5, 96)):
-                yield set_filter_val(pack_vals(*f_vals))
+            yield from POINTWISE_PARAM_OPS
+            yield from POINTWISE_FILTER_OPS
 
             for i_vals in zip(nums(1, 4), nums(3, 4), nums(5, 4), nums(7, 4)):
                 yield set_input_val(pack_vals(*i_vals))
@@ -471,34 +484,92 @@ class CfuTest(CfuTestBase):
                 yield set_filter_val(pack_vals(-37, -13, -12, -106))  # (0 1 2 3)
                 yield set_filter_val(pack_vals(-7, 0, 0, 0))  # (0 1 2 3)
 
+            # Every row of the input repeats the same words, so pack them once
+            aa_word = set_input_val(pack_vals(aa[0], aa[1], aa[12], aa[13]))
+            bb_word = set_input_val(pack_vals(bb[0], bb[1], bb[12], bb[13]))
+            pad_word = set_input_val(pack_vals(0, 0, 0, 0))
+            tile_output = get_output(pack_vals(100, 100, 101, 101))
+
             for j in range(21):
                 for i in range(input_width):
-                    yield set_input_val(pack_vals(aa[0], aa[1], aa[12], aa[13]))
+                    yield aa_word
                 for k in range(pad):
-                    yield set_input_val(pack_vals(0, 0, 0, 0))
+                    yield pad_word
 
             # Start calculation
             yield set_reg(33, 0)
 
             for j in range(num_tile):
-                yield get_output(pack_vals(100, 100, 101, 101))  # n=42
+                yield tile_output  # n=42
 
             for j in range(21):
                 for i in range(input_width):
-                    yield set_input_val(pack_vals(bb[0], bb[1], bb[12], bb[13]))
+                    yield bb_word
                 for k in range(pad):
-                    yield set_input_val(pack_vals(0, 0, 0, 0))
+                    yield pad_word
 
             # Start calculation
             yield set_reg(33, 0)
 
 
             for j in range(num_tile):
-                yield get_output(pack_vals(100, 100, 101, 101))  # n=42
+                yield tile_output  # n=42
 
         return self.run_ops(make_op_stream(), 1)
 
 
+class FixedWidthCfuTest(CfuTest):
+    """Runs the CfuTest op streams with input_width fixed at build time.
+
+    The set_input_width register (37) is left out, so its writes are
+    ignored, and the row pad comes from the Python lookup rather than
+    the runtime table.
+    """
+    def create_dut(self):
+        return make_cfu(input_width=41)
+
+
+class _SingleModeCfuTest:
+    """Runs the CfuTest op streams on a single mode build.
+
+    A single mode build has no switch_PorD register (35), so those writes
+    are left out, along with the ops they switch to the other mode.
+    """
+    mode = None
+
+    def create_dut(self):
+        return make_cfu(self.mode)
+
+    def run_ops(self, data, write_trace=False):
+        def ops_in_mode():
+            depthwise = False
+            checked = 0
+            for inputs, expected in data:
+                _, funct7, in0, _ = self._unpack(inputs)
+                if funct7 == 35:
+                    depthwise = bool(in0)
+                elif depthwise == (self.mode == 'depthwise'):
+                    checked += expected != 0
+                    yield inputs, expected
+            # A stream with every checked op filtered out would pass vacuously
+            self.assertGreater(checked, 0, f"no {self.mode} outputs checked")
+        return super().run_ops(ops_in_mode(), write_trace)
+
+
+class PointwiseCfuTest(_SingleModeCfuTest, CfuTest):
+    mode = 'pointwise'
+
+    def test_depthwise_conv(self):
+        self.skipTest("test_depthwise_conv has no pointwise ops")
+
+
+class DepthwiseCfuTest(_SingleModeCfuTest, CfuTest):
+    mode = 'depthwise'
+
+    def test_2dconv(self):
+        self.skipTest("test_2dconv has no depthwise ops")
+
+
 '''class mnv2Test(unittest.TestCase):
     def setUp(self):               ### (D)
         self.m = Module()
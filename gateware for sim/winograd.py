@@ -0,0 +1,86 @@
+#!/bin/env python
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from amaranth import Cat, Const, Value
+
+# Transform matrices for Winograd F(2x2, 3x3).
+#
+# The filter matrix is scaled by 2 so that every coefficient is an integer;
+# the resulting factor of 4 is removed after the output transform. The
+# scaling stays in gateware, where it is only wiring, because the filter
+# store holds raw int8 taps and scaled taps would not fit in a byte.
+
+# Filter transform, applied as G.g.G^T
+G = [[2, 0, 0],
+     [1, 1, 1],
+     [1, -1, 1],
+     [0, 0, 2]]
+
+# Input transform, applied as B^T.d.B
+B_T = [[1, 0, -1, 0],
+       [0, 1, 1, 0],
+       [0, -1, 1, 0],
+       [0, 1, 0, -1]]
+
+# Output transform, applied as A^T.M.A
+A_T = [[1, 1, 1, 0],
+       [0, 1, -1, -1]]
+
+
+def block_lane(r, c):
+    """Lane holding element (r, c) of a 4x4 tile.
+
+    Tiles are laid out as four 2x2 blocks, each block in row major order.
+    """
+    return 8 * (r // 2) + 4 * (c // 2) + 2 * (r % 2) + (c % 2)
+
+
+def _shift_left(value, shift):
+    """value << shift, built from wiring with constant zero low bits"""
+    if not isinstance(value, Value):
+        return value << shift
+    shifted = Cat(Const(0, shift), value)
+    return shifted.as_signed() if value.shape().signed else shifted
+
+
+def _balanced_sum(terms):
+    """Sums terms as a balanced tree of adders"""
+    while len(terms) > 1:
+        pairs = [terms[i] + terms[i + 1] for i in range(0, len(terms) - 1, 2)]
+        terms = pairs + terms[2 * len(pairs):]
+    return terms[0]
+
+
+def weighted_sum(coeffs, values):
+    """Sums values, each multiplied by a small integer coefficient.
+
+    Coefficients must be zero or plus or minus a power of two. Zero terms are
+    dropped and powers of two become shifts, so no multipliers are built.
+    Positive and negative terms are each summed as a balanced tree, and the
+    negative sum is then subtracted, so there is no separate negation.
+    """
+    positive, negative = [], []
+    for coeff, value in zip(coeffs, values):
+        if coeff == 0:
+            continue
+        shift = abs(coeff).bit_length() - 1
+        assert abs(coeff) == 1 << shift, f"{coeff} is not a power of two"
+        term = _shift_left(value, shift) if shift else value
+        (positive if coeff > 0 else negative).append(term)
+    if not negative:
+        return _balanced_sum(positive)
+    if not positive:
+        return -_balanced_sum(negative)
+    return _balanced_sum(positive) - _balanced_sum(negative)
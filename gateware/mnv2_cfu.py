@@ -13,7 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from amaranth import Signal,Cat
+from amaranth import Array, Cat, Const, Mux, Signal
 from amaranth.lib.fifo import SyncFIFOBuffered
 from amaranth_cfu import simple_cfu, DualPortMemory, is_pysim_run
 import math
@@ -34,6 +34,23 @@ from .sequencing import Sequencer,UpCounter
 
 
 class Mnv2RegisterInstruction(RegisterFileInstruction):
+    """Register file instruction that runs Mobilenet v2 convolutions.
+
+    Parameters
+    ----------
+    mode: str
+        Which convolutions to build hardware for: 'pointwise', 'depthwise'
+        or 'both'. Only 'both' has the set_switch_PorD register (35).
+    input_width: int
+        Depthwise input width, if it is fixed at build time. When given,
+        the set_input_width register (37) is left out and the row padding
+        is a constant. When None, the width is set at run time.
+    """
+
+    def __init__(self, mode='both', input_width=None):
+        super().__init__()
+        self.mode = mode
+        self.input_width = input_width
 
     def _make_setter(self, m, reg_num, name):
         """Constructs and registers a simple RegisterSetter.
@@ -45,31 +62,42 @@ class Mnv2RegisterInstruction(RegisterFileInstruction):
         self.register_xetter(reg_num, setter)
         return setter.value, setter.set
 
-    def _make_output_channel_param_store(
-            self, m, reg_num, name, restart_signal):
-        """Constructs and registers a param store connected to a memory
-        and a circular incrementer.
+    def _make_output_channel_param_stores(
+            self, m, reg_nums, names, restart_signal):
+        """Constructs and registers param stores, each connected to a
+        memory, that share a single circular incrementer.
 
-        Returns a pair of signals: (current data, inc.next)
+        The stores are filled together, one value per output channel, so
+        they always hold the same number of items and are read at the
+        same address. The incrementer is limited by the first store.
+
+        Returns a list of current data signals, one per store, and
+        inc.next.
         """
-        m.submodules[f'{name}_dp'] = dp = DualPortMemory(
-            width=32, depth=config.OUTPUT_CHANNEL_PARAM_DEPTH, is_sim=is_pysim_run())
-        m.submodules[f'{name}_inc'] = inc = CircularIncrementer(
+        m.submodules[f'{names[0]}_inc'] = inc = CircularIncrementer(
             config.OUTPUT_CHANNEL_PARAM_DEPTH)
-        m.submodules[f'{name}_set'] = psset = StoreSetter(
-            32, 1, config.OUTPUT_CHANNEL_PARAM_DEPTH)
-        self.register_xetter(reg_num, psset)
+        datas, counts = [], []
+        for reg_num, name in zip(reg_nums, names):
+            m.submodules[f'{name}_dp'] = dp = DualPortMemory(
+                width=32, depth=config.OUTPUT_CHANNEL_PARAM_DEPTH, is_sim=is_pysim_run())
+            m.submodules[f'{name}_set'] = psset = StoreSetter(
+                32, 1, config.OUTPUT_CHANNEL_PARAM_DEPTH)
+            self.register_xetter(reg_num, psset)
+            m.d.comb += [
+                # Restart param store when reg is set
+                psset.restart.eq(restart_signal),
+                # Hook memory up to the shared incrementer
+                dp.r_addr.eq(inc.r_addr),
+            ]
+            m.d.comb += psset.connect_write_port([dp])
+            datas.append(dp.r_data)
+            counts.append(psset.count)
         m.d.comb += [
-            # Restart param store when reg is set
-            psset.restart.eq(restart_signal),
             inc.restart.eq(restart_signal),
             # Incrementer is limited to number of items already set
-            inc.limit.eq(psset.count),
-            # Hook memory up to various components
-            dp.r_addr.eq(inc.r_addr),
+            inc.limit.eq(counts[0]),
         ]
-        m.d.comb += psset.connect_write_port([dp])
-        return dp.r_data, inc.next
+        return datas, inc.next
 
     def _make_filter_value_store(
             self, m, reg_num, name, restart_signal):
@@ -96,7 +124,7 @@ class Mnv2RegisterInstruction(RegisterFileInstruction):
 
     def _make_input_store(self, m, name, restart_signal, input_depth_words,offset):
         m.submodules[f'{name}'] = ins = InputStore(
-            config.MAX_PER_PIXEL_INPUT_WORDS)
+            config.MAX_PER_PIXEL_INPUT_WORDS, self.mode)
         m.submodules[f'{name}_set'] = insset = InputStoreSetter()
         m.d.comb += insset.connect(ins)
         self.register_xetter(25, insset)
@@ -144,7 +172,11 @@ class Mnv2RegisterInstruction(RegisterFileInstruction):
             fifo.r_en.eq(oq_get.next),
         ]
         self.register_xetter(34, oq_get)
-        oq_has_space = fifo.w_level < (config.OUTPUT_QUEUE_DEPTH - 8)
+        # Registered to keep the FIFO level off the gate path. One more word
+        # may be written while it settles, so the margin is one larger.
+        oq_has_space = Signal()
+        m.d.sync += oq_has_space.eq(
+            fifo.w_level < (config.OUTPUT_QUEUE_DEPTH - 9))
         return fifo.w_data, fifo.w_en, oq_has_space
 
     def elab_xetters(self, m):
@@ -157,54 +189,45 @@ class Mnv2RegisterInstruction(RegisterFileInstruction):
         activation_min, _ = self._make_setter(m, 14, 'set_activation_min')
         activation_max, _ = self._make_setter(m, 15, 'set_activation_max')
 
-        switch_PorD, _ = self._make_setter(m, 35, 'set_switch_PorD')
+        if self.mode == 'both':
+            switch_PorD, _ = self._make_setter(m, 35, 'set_switch_PorD')
+        else:
+            # Single mode builds have no register 35. switch_PorD is tied to
+            # the built mode, so no module can select the mode left out.
+            switch_PorD = Const(self.mode == 'depthwise', 1)
         num_tile, _ = self._make_setter(m, 36, 'set_num_tile')
-        input_width, _ = self._make_setter(m, 37, 'set_input_width')
-        pad=Signal(4)
-        with m.If(input_width[:2]==0):
-            m.d.comb += pad.eq(2)
-        with m.Elif(input_width[:2]==1):
-            m.d.comb += pad.eq(1)
-        with m.Elif(input_width[:2]==2):
-            m.d.comb += pad.eq(0)
-        with m.Else():
-            m.d.comb += pad.eq(3)
-        input_depth_words_my=Signal(32)
-
-        # set num_tile= (pow(Input depth ,0.5)-2)/2,but now num_tile=2
-
+        # Row padding that makes input_width + pad 2 mod 4
+        pads = (2, 1, 0, 3)
+        pad = Signal(4)
+        if self.input_width is None:
+            input_width, _ = self._make_setter(m, 37, 'set_input_width')
+            m.d.comb += pad.eq(Array(Const(p, 4) for p in pads)[input_width[:2]])
+        else:
+            input_width = Const(self.input_width, 32)
+            m.d.comb += pad.eq(pads[self.input_width & 3])
 
         # Stores of input and output data
         _, restart = self._make_setter(m, 20, 'set_output_batch_size')
-        multiplier, multiplier_next = self._make_output_channel_param_store(
-            m, 21, 'store_output_multiplier', restart)
-        shift, shift_next = self._make_output_channel_param_store(
-            m, 22, 'store_output_shift', restart)
-        bias, bias_next = self._make_output_channel_param_store(
-            m, 23, 'store_output_bias', restart)
+        (multiplier, shift, bias), param_next = self._make_output_channel_param_stores(
+            m, (21, 22, 23),
+            ('store_output_multiplier', 'store_output_shift', 'store_output_bias'),
+            restart)
         fv_mems, fv_count, fv_updated = self._make_filter_value_store(
             m, 24, 'store_filter_values', restart)
 
         m.submodules['fvf'] = fvf = FilterValueFetcher(
-            config.FILTER_DATA_MEM_DEPTH)
-        m.d.comb += fvf.connect_read_ports(fv_mems)
-        m.d.comb += [
+            config.FILTER_DATA_MEM_DEPTH, self.mode)
+        m.d.comb += fvf.connect_read_ports(fv_mems) + [
             # fetcher only works for multiples of 4, and only for multiples of
             # 4 > 8
-            fvf.limit.eq(fv_count ),
+            fvf.limit.eq(fv_count),
             fvf.updated.eq(fv_updated),
             fvf.restart.eq(restart),
             fvf.switch_PorD.eq(switch_PorD),
         ]
 
-        # ins, ins_r_finished = self._make_input_store(
-        #     m, 'ins', set_id, input_depth_words_my,input_offset)
-        # m.d.comb += [ins.switch_PorD.eq(switch_PorD),
-        #              ins.input_width.eq(input_width),
-        #              ins.pad.eq(pad)]
         ins, ins_r_finished = self._make_input_store(
             m, 'ins', set_id, input_depth_words,input_offset)
-        # m.d.comb += ins.switch_PorD.eq(switch_PorD)
         m.d.comb += [ins.switch_PorD.eq(switch_PorD),
                      ins.input_width.eq(input_width),
                      ins.pad.eq(pad)]
@@ -226,63 +249,32 @@ class Mnv2RegisterInstruction(RegisterFileInstruction):
             mul.switch_PorD.eq(switch_PorD),
         ]
 
-        m.submodules['acc'] = acc = AccOrTrans()
-        for n in range(16):
-            m.d.comb += acc.in_values[n].eq(mul.products[n])
-        m.d.comb += acc.switch_PorD.eq(switch_PorD)
-
-        m.submodules['pp_0'] = pp_0 = PostProcessor()
+        m.submodules['acc'] = acc = AccOrTrans(self.mode)
         m.d.comb += [
-            pp_0.offset.eq(output_offset),
-            pp_0.activation_min.eq(activation_min),
-            pp_0.activation_max.eq(activation_max),
-            pp_0.bias.eq(bias),
-            pp_0.multiplier.eq(multiplier),
-            pp_0.shift.eq(shift),
-            pp_0.accumulator.eq(acc.result[0]),
+            acc.in_values.eq(mul.products),
+            acc.switch_PorD.eq(switch_PorD),
         ]
 
-        m.submodules['pp_1'] = pp_1 = PostProcessor()
-        m.d.comb += [
-            pp_1.offset.eq(output_offset),
-            pp_1.activation_min.eq(activation_min),
-            pp_1.activation_max.eq(activation_max),
-            pp_1.bias.eq(bias),
-            pp_1.multiplier.eq(multiplier),
-            pp_1.shift.eq(shift),
-            pp_1.accumulator.eq(acc.result[1]),
-        ]
-
-        m.submodules['pp_2'] = pp_2 = PostProcessor()
-        m.d.comb += [
-            pp_2.offset.eq(output_offset),
-            pp_2.activation_min.eq(activation_min),
-            pp_2.activation_max.eq(activation_max),
-            pp_2.bias.eq(bias),
-            pp_2.multiplier.eq(multiplier),
-            pp_2.shift.eq(shift),
-            pp_2.accumulator.eq(acc.result[2]),
-        ]
-
-        m.submodules['pp_3'] = pp_3 = PostProcessor()
-        m.d.comb += [
-            pp_3.offset.eq(output_offset),
-            pp_3.activation_min.eq(activation_min),
-            pp_3.activation_max.eq(activation_max),
-            pp_3.bias.eq(bias),
-            pp_3.multiplier.eq(multiplier),
-            pp_3.shift.eq(shift),
-            pp_3.accumulator.eq(acc.result[3]),
-        ]
+        # One post processor per accumulator result
+        pps = [PostProcessor() for _ in range(4)]
+        for n, pp in enumerate(pps):
+            m.submodules[f'pp_{n}'] = pp
+            m.d.comb += [
+                pp.offset.eq(output_offset),
+                pp.activation_min.eq(activation_min),
+                pp.activation_max.eq(activation_max),
+                pp.bias.eq(bias),
+                pp.multiplier.eq(multiplier),
+                pp.shift.eq(shift),
+                pp.accumulator.eq(acc.result[n]),
+            ]
 
         m.submodules['btw'] = btw = ByteToWordShifter()
-        m.d.comb += btw.in_value.eq(pp_0.result)
+        m.d.comb += btw.in_value.eq(pps[0].result)
 
         # Sequencer
         _, start_run = self._make_setter(m, 33, 'start_run')
-        m.submodules['seq'] = seq = Sequencer()
-
-
+        m.submodules['seq'] = seq = Sequencer(self.mode)
         m.d.comb += [
             seq.restart.eq(restart),
             seq.num_tile.eq(num_tile),
@@ -301,21 +293,18 @@ class Mnv2RegisterInstruction(RegisterFileInstruction):
             acc.add_en.eq(seq.mul_done),
             acc.clear.eq(seq.acc_done),
 
-            bias_next.eq(seq.acc_done),
-            multiplier_next.eq(seq.acc_done),
-            shift_next.eq(seq.acc_done),
+            param_next.eq(seq.acc_done),
 
             btw.shift_en.eq(seq.pp_done),
-            #oq_w_data.eq(btw.result),
             oq_enable.eq(seq.out_word_done),
+            # Pointwise packs one result per word through btw, depthwise
+            # writes all four post processor results at once
+            oq_w_data.eq(Mux(switch_PorD, Cat(*[pp.result for pp in pps]),
+                             btw.result)),
         ]
 
-        with m.If(switch_PorD==0):
-            m.d.comb += oq_w_data.eq(btw.result) 
-        with m.Else():
-            m.d.comb += oq_w_data.eq(Cat(pp_0.result,pp_1.result,pp_2.result,pp_3.result)) 
 
-def make_cfu():
+def make_cfu(mode='both', input_width=None):
     return simple_cfu({
-            0: Mnv2RegisterInstruction(),
+            0: Mnv2RegisterInstruction(mode, input_width),
         })
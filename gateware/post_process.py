@@ -262,8 +262,7 @@ class PostProcessXetter(Xetter):
         ]
 
         # Use a sequencer to count down to processing end
-        m.submodules['delay'] = delay = Delayer()
-        m.d.comb +=delay.cycles.eq(PostProcessor.PIPELINE_CYCLES)
+        m.submodules['delay'] = delay = Delayer(PostProcessor.PIPELINE_CYCLES)
         m.d.comb += delay.input.eq(self.start)
 
         # Other control signal outputs - set *_next to indicate values used
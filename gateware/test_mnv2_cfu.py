@@ -20,11 +20,14 @@ from amaranth.build import Platform
 from amaranth.hdl.ast import Cat
 from amaranth.sim import Simulator
 
+import functools
 import unittest
 
 from mnv2_cfu import make_cfu
 
 
+# The tests pack the same few words many times over
+@functools.lru_cache(maxsize=None)
 def pack_vals(*values, offset=0, bits=8):
     """Packs single values into a word in little endian order.
     offset is added to the values before packing
@@ -37,6 +40,29 @@ def pack_vals(*values, offset=0, bits=8):
     return result
 
 
+# (bias, multiplier, shift) of each group of four output channels in the
+# pointwise tests
+POINTWISE_CHANNEL_PARAMS = (
+    (30_000, 31_000_000, -3),
+    (50_000, 50_000_000, -6),
+    (75_000, 56_000_000, -4),
+    (100_000, 50_000_000, -5),
+)
+
+# Register writes that load the pointwise tests' output channel params for
+# 24 channels, and their 96 filter words. Every pointwise run loads the same
+# values, so the ops are built once.
+POINTWISE_PARAM_OPS = tuple(
+    ((0, reg, val, 0), 0)
+    for _ in range(6)
+    for bias, mult, shift in POINTWISE_CHANNEL_PARAMS
+    for reg, val in ((21, mult), (22, shift), (23, bias)))
+POINTWISE_FILTER_OPS = tuple(
+    ((0, 24, pack_vals(*f_vals), 0), 0)
+    for f_vals in zip(range(-17, 79), range(3, 99),
+                      range(-50, 46), range(5, 101)))
+
+
 class SimpleElaboratable(Elaboratable):
     """Simplified Elaboratable interface
     Widely, but not generally applicable. Suitable for use with
@@ -80,12 +106,17 @@ class TestBase(unittest.TestCase):
     The module can use sync, comb or both.
     """
 
+    # Set when the DUT is known to contain synchronous logic, so no
+    # placeholder needs to be simulated alongside it
+    has_sync_logic = False
+
     def setUp(self):
         # Create DUT and add to simulator
         self.m = Module()
         self.dut = self.create_dut()
         self.m.submodules['dut'] = self.dut
-        self.m.submodules['placeholder'] = _PlaceholderSyncModule()
+        if not self.has_sync_logic:
+            self.m.submodules['placeholder'] = _PlaceholderSyncModule()
         self.sim = Simulator(self.m)
 
     def create_dut(self):
@@ -117,6 +148,8 @@ class TestBase(unittest.TestCase):
 class CfuTestBase(TestBase):
     """Tests CFU ops independent of timing and handshaking."""
 
+    has_sync_logic = True
+
     def _unpack(self, inputs):
         return inputs if len(inputs) == 4 else (
             inputs[0], 0, inputs[1], inputs[2])
@@ -151,13 +184,17 @@ class CfuTestBase(TestBase):
                 # Ensure no errors, and output as expected
                 if expected !=0:
                     actual = (yield self.dut.rsp_out)
-                    self.assertEqual(actual, expected & 0xffff_ffff,
-                                     f"output {hex(actual)} != {hex(expected & 0xffff_ffff)} ::: " +
-                                     f"function_id={function_id}, funct7={funct7}, " +
-                                     f" in0={in0} {hex(in0)}, in1={in1} {hex(in1)} (n={n})")
-                yield
-            for n in range(20):
+                    expected &= 0xffff_ffff
+                    # The message is only formatted on failure
+                    if actual != expected:
+                        self.fail(f"output {hex(actual)} != {hex(expected)} ::: " +
+                                  f"function_id={function_id}, funct7={funct7}, " +
+                                  f" in0={in0} {hex(in0)}, in1={in1} {hex(in1)} (n={n})")
                 yield
+            # Idle cycles only show the tail of a run in the trace
+            if write_trace:
+                for n in range(20):
+                    yield
         self.run_sim(process, write_trace)
 
 
@@ -263,14 +300,6 @@ class CfuTest(CfuTestBase):
         def set_reg(reg, val):
             return ((0, reg, val, 0), 0)
 
-        def set_out_channel_params(bias, mult, shift):
-            yield set_reg(21, mult)
-            yield set_reg(22, shift)
-            yield set_reg(23, bias)
-
-        def set_filter_val(val):
-            return ((0, 24, val, 0), 0)
-
         def set_input_val(val):
             return ((0, 25, val, 0), 0)
 
@@ -293,15 +322,8 @@ class CfuTest(CfuTestBase):
             yield set_reg(14, -128)
             yield set_reg(15, 127)
 
-            for _ in range(6):
-                yield from set_out_channel_params(30_000, 31_000_000, -3)
-                yield from set_out_channel_params(50_000, 50_000_000, -6)
-                yield from set_out_channel_params(75_000, 56_000_000, -4)
-                yield from set_out_channel_params(100_000, 50_000_000, -5)
-
-            for f_vals in zip(nums(-17, 96), nums(3, 96),
-                              nums(-50, 96), nums(5, 96)):
-                yield set_filter_val(pack_vals(*f_vals))
+            yield from POINTWISE_PARAM_OPS
+            yield from POINTWISE_FILTER_OPS
 
             for i_vals in zip(nums(1, 4), nums(3, 4), nums(5, 4), nums(7, 4)):
                 yield set_input_val(pack_vals(*i_vals))
@@ -380,15 +402,8 @@ class CfuTest(CfuTestBase):
             yield set_reg(15, 127)
             yield set_reg(20, 24)
 
-            for _ in range(6):
-                yield from set_out_channel_params(30_000, 31_000_000, -3)
-                yield from set_out_channel_params(50_000, 50_000_000, -6)
-                yield from set_out_channel_params(75_000, 56_000_000, -4)
-                yield from set_out_channel_params(100_000, 50_000_000, -5)
-
-            for f_vals in zip(nums(-17, 96), nums(3, 96),
-                              nums(-50, 96), nums(5, 96)):
-                yield set_filter_val(pack_vals(*f_vals))
+            yield from POINTWISE_PARAM_OPS
+            yield from POINTWISE_FILTER_OPS
 
             for i_vals in zip(nums(1, 4), nums(3, 4), nums(5, 4), nums(7, 4)):
                 yield set_input_val(pack_vals(*i_vals))
@@ -464,98 +479,50 @@ class CfuTest(CfuTestBase):
 
 #pading is special! pading is special! pading is special!
             #print(pack_vals(0-input_offset, 0-input_offset, 0-input_offset, 23-input_offset))
-            for i in range(input_channel_4):
-
-                for j in range(num_tile):
-                    yield set_input_val(pack_vals(0-input_offset, 0-input_offset, 0-input_offset, 23-input_offset))
-                    yield set_input_val(pack_vals(0-input_offset, 0-input_offset, 23-input_offset, 23-input_offset))
-                    yield set_input_val(pack_vals(0-input_offset, 23-input_offset, 0-input_offset, 23-input_offset))
-                    yield set_input_val(pack_vals(23-input_offset, 23-input_offset, 23-input_offset, 23-input_offset))
-
-                # Start calculation
-                yield set_reg(33, 0)
-
-                for j in range(num_tile):
-                    yield get_output(pack_vals(100, 100, 101, 101))#n=42
-
-
-
-
-
-                for j in range(num_tile_4):
-                    yield set_input_val(pack_vals(34-input_offset, 38-input_offset, 83-input_offset, 97-input_offset))
-                    yield set_input_val(pack_vals(52-input_offset, 61-input_offset, 104-input_offset, 98-input_offset))
-                    yield set_input_val(pack_vals(89-input_offset, 98-input_offset, 93-input_offset, 95-input_offset))
-                    yield set_input_val(pack_vals(86-input_offset, 96-input_offset, 86-input_offset, 84-input_offset))
-
-                    yield set_input_val(pack_vals(92-input_offset, 92-input_offset, 95-input_offset, 105-input_offset))
-                    yield set_input_val(pack_vals(70-input_offset, 0-input_offset, 78-input_offset, 0-input_offset))
-                    yield set_input_val(pack_vals(102-input_offset, 101-input_offset, 90-input_offset, 95-input_offset))
-                    yield set_input_val(pack_vals(74-input_offset, 0-input_offset, 75-input_offset, 0-input_offset))
-
-                    yield set_input_val(pack_vals(0-input_offset, 0-input_offset, 0-input_offset, 79-input_offset))
-                    yield set_input_val(pack_vals(0-input_offset, 0-input_offset, 82-input_offset, 80-input_offset))
-                    yield set_input_val(pack_vals(0-input_offset, 23-input_offset, 0-input_offset, 51-input_offset))
-                    yield set_input_val(pack_vals(40-input_offset, 34-input_offset, 46-input_offset, 61-input_offset))
-
-                    yield set_input_val(pack_vals(40-input_offset, 34-input_offset, 46-input_offset, 61-input_offset))
-                    yield set_input_val(pack_vals(34-input_offset, 38-input_offset, 83-input_offset, 97-input_offset))
-                    yield set_input_val(pack_vals(82-input_offset, 92-input_offset, 98-input_offset, 89-input_offset))
-                    yield set_input_val(pack_vals(89-input_offset, 98-input_offset, 93-input_offset, 95-input_offset))
-
-
-
-
-                # Start calculation
-                yield set_reg(33, 0)
-
-                for j in range(num_tile_4):
-                    yield get_output(pack_vals(-128, -128, -122, -120))#n=42
-                    yield get_output(pack_vals(-102, 10, -93, 5))#n=42
-                    yield get_output(pack_vals(-128, -128, -128, -128))#n=42
-                    yield get_output(pack_vals(-128, -128, -128, -128))#n=42
-
-
-
-
-
-                for j in range(num_tile):
-                    yield set_input_val(pack_vals(0-input_offset, 0-input_offset, 0-input_offset, 145-input_offset))
-                    yield set_input_val(pack_vals(0-input_offset, 0-input_offset, 145-input_offset, 145-input_offset))
-                    yield set_input_val(pack_vals(0-input_offset, 145-input_offset, 0-input_offset, 145-input_offset))
-                    yield set_input_val(pack_vals(145-input_offset, 145-input_offset, 145-input_offset, 145-input_offset))
-
-                # Start calculation
-                yield set_reg(33, 0)
-
-                for j in range(num_tile):
-                    yield get_output(pack_vals(127, 127, 32, 32))#n=42
-
-
-
-                
-
-
-
-
-
-                for j in range(num_tile_half):
-                    yield set_input_val(pack_vals(34-input_offset, 38-input_offset, 83-input_offset, 97-input_offset))
-                    yield set_input_val(pack_vals(52-input_offset, 61-input_offset, 104-input_offset, 98-input_offset))
-                    yield set_input_val(pack_vals(89-input_offset, 98-input_offset, 93-input_offset, 95-input_offset))
-                    yield set_input_val(pack_vals(86-input_offset, 96-input_offset, 86-input_offset, 84-input_offset))
-                    yield set_input_val(pack_vals(92-input_offset, 92-input_offset, 95-input_offset, 105-input_offset))
-                    yield set_input_val(pack_vals(70-input_offset, 0-input_offset, 78-input_offset, 0-input_offset))
-                    yield set_input_val(pack_vals(102-input_offset, 101-input_offset, 90-input_offset, 95-input_offset))
-                    yield set_input_val(pack_vals(74-input_offset, 0-input_offset, 75-input_offset, 0-input_offset))
+            # Every tile repeats the same words, so pack them once
+            def input_ops(*vals):
+                return [set_input_val(pack_vals(*v, offset=-input_offset))
+                        for v in vals]
+
+            def output_ops(*vals):
+                return [get_output(pack_vals(*v)) for v in vals]
+
+            tile_23_ops = input_ops(
+                (0, 0, 0, 23), (0, 0, 23, 23), (0, 23, 0, 23), (23, 23, 23, 23))
+            tile_145_ops = input_ops(
+                (0, 0, 0, 145), (0, 0, 145, 145), (0, 145, 0, 145),
+                (145, 145, 145, 145))
+            image_ops = input_ops(
+                (34, 38, 83, 97), (52, 61, 104, 98), (89, 98, 93, 95),
+                (86, 96, 86, 84), (92, 92, 95, 105), (70, 0, 78, 0),
+                (102, 101, 90, 95), (74, 0, 75, 0),
+                (0, 0, 0, 79), (0, 0, 82, 80), (0, 23, 0, 51), (40, 34, 46, 61),
+                (40, 34, 46, 61), (34, 38, 83, 97), (82, 92, 98, 89),
+                (89, 98, 93, 95))
+            image_out_ops = output_ops(
+                (-128, -128, -122, -120), (-102, 10, -93, 5),
+                (-128, -128, -128, -128), (-128, -128, -128, -128))
+            out_23_op = get_output(pack_vals(100, 100, 101, 101))
+            out_145_op = get_output(pack_vals(127, 127, 32, 32))
+
+            # Each run's input and output ops, built once for all channels
+            runs = [
+                (tile_23_ops * num_tile, [out_23_op] * num_tile),
+                (image_ops * num_tile_4, image_out_ops * num_tile_4),
+                (tile_145_ops * num_tile, [out_145_op] * num_tile),
+                # The first eight words of the image, twice as many times
+                (image_ops[:8] * num_tile_half,
+                 image_out_ops[:2] * num_tile_half),
+            ]
 
+            for i in range(input_channel_4):
+                for input_run, output_run in runs:
+                    yield from input_run
 
-                # Start calculation
-                yield set_reg(33, 0)
+                    # Start calculation
+                    yield set_reg(33, 0)
 
-                for j in range(num_tile_half):
-                    yield get_output(pack_vals(-128, -128, -122, -120))#n=42
-                    yield get_output(pack_vals(-102, 10, -93, 5))#n=42
+                    yield from output_run#n=42
 
 
 
@@ -573,15 +540,8 @@ class CfuTest(CfuTestBase):
             yield set_reg(14, -128)
             yield set_reg(15, 127)
 
-            for _ in range(6):
-                yield from set_out_channel_params(30_000, 31_000_000, -3)
-                yield from set_out_channel_params(50_000, 50_000_000, -6)
-                yield from set_out_channel_params(75_000, 56_000_000, -4)
-                yield from set_out_channel_params(100_000, 50_000_000, -5)
-
-            for f_vals in zip(nums(-17, 96), nums(3, 96),
-                              nums(-50, 96), nums(5, 96)):
-                yield set_filter_val(pack_vals(*f_vals))
+            yield from POINTWISE_PARAM_OPS
+            yield from POINTWISE_FILTER_OPS
 
             for i_vals in zip(nums(1, 4), nums(3, 4), nums(5, 4), nums(7, 4)):
                 yield set_input_val(pack_vals(*i_vals))
@@ -604,6 +564,58 @@ class CfuTest(CfuTestBase):
         return self.run_ops(make_op_stream(), 1)
 
 
+class FixedWidthCfuTest(CfuTest):
+    """Runs the CfuTest op streams with input_width fixed at build time.
+
+    The set_input_width register (37) is left out, so its writes are
+    ignored, and the row pad comes from the Python lookup rather than
+    the runtime table.
+    """
+    def create_dut(self):
+        return make_cfu(input_width=41)
+
+
+class _SingleModeCfuTest:
+    """Runs the CfuTest op streams on a single mode build.
+
+    A single mode build has no switch_PorD register (35), so those writes
+    are left out, along with the ops they switch to the other mode.
+    """
+    mode = None
+
+    def create_dut(self):
+        return make_cfu(self.mode)
+
+    def run_ops(self, data, write_trace=False):
+        def ops_in_mode():
+            depthwise = False
+            checked = 0
+            for inputs, expected in data:
+                _, funct7, in0, _ = self._unpack(inputs)
+                if funct7 == 35:
+                    depthwise = bool(in0)
+                elif depthwise == (self.mode == 'depthwise'):
+                    checked += expected != 0
+                    yield inputs, expected
+            # A stream with every checked op filtered out would pass vacuously
+            self.assertGreater(checked, 0, f"no {self.mode} outputs checked")
+        return super().run_ops(ops_in_mode(), write_trace)
+
+
+class PointwiseCfuTest(_SingleModeCfuTest, CfuTest):
+    mode = 'pointwise'
+
+    def test_depthwise_conv(self):
+        self.skipTest("test_depthwise_conv has no pointwise ops")
+
+
+class DepthwiseCfuTest(_SingleModeCfuTest, CfuTest):
+    mode = 'depthwise'
+
+    def test_2dconv(self):
+        self.skipTest("test_2dconv has no depthwise ops")
+
+
 '''class mnv2Test(unittest.TestCase):
     def setUp(self):               ### (D)
         self.m = Module()
@@ -0,0 +1,78 @@
+#!/bin/env python
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import unittest
+
+from amaranth import Signal, signed, unsigned
+
+from .winograd import A_T, B_T, G, block_lane, weighted_sum
+
+
+def _transform(left, x, right_t):
+    """Returns left.x.right_t^T using weighted_sum"""
+    lx = [[weighted_sum(row, [x[k][c] for k in range(len(x))])
+           for c in range(len(x[0]))] for row in left]
+    return [[weighted_sum(row, lx_row) for row in right_t] for lx_row in lx]
+
+
+class WinogradTest(unittest.TestCase):
+    def test_block_lane(self):
+        lanes = [[block_lane(r, c) for c in range(4)] for r in range(4)]
+        self.assertEqual(lanes, [[0, 1, 4, 5],
+                                 [2, 3, 6, 7],
+                                 [8, 9, 12, 13],
+                                 [10, 11, 14, 15]])
+
+    def test_weighted_sum(self):
+        self.assertEqual(weighted_sum([1, 0, -1, 2], [3, 100, 5, 7]), 12)
+        self.assertEqual(weighted_sum([0, -1, 4], [9, 3, 2]), 5)
+        with self.assertRaises(AssertionError):
+            weighted_sum([3], [1])
+
+    def test_weighted_sum_no_negation(self):
+        a, b = Signal(signed(8)), Signal(signed(8))
+        result = weighted_sum([-1, 1], [a, b])
+        self.assertEqual(result.operator, '-')
+        self.assertEqual(len(result.operands), 2)
+        self.assertIs(result.operands[0], b)
+
+    def test_weighted_sum_balanced(self):
+        def depth(value):
+            operands = getattr(value, 'operands', [])
+            return 1 + max(map(depth, operands)) if operands else 0
+        values = [Signal(signed(8)) for _ in range(8)]
+        self.assertEqual(depth(weighted_sum([1] * 8, values)), 3)
+        self.assertEqual(depth(weighted_sum([1, -1] * 4, values)), 3)
+        self.assertEqual(weighted_sum([1, -1] * 4, list(range(8))), -4)
+
+    def test_weighted_sum_shift_shape(self):
+        self.assertEqual(weighted_sum([4], [Signal(signed(8))]).shape(), signed(10))
+        self.assertEqual(weighted_sum([2], [Signal(8)]).shape(), unsigned(9))
+
+    def test_convolution(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            d = [[rng.randint(-128, 127) for _ in range(4)] for _ in range(4)]
+            g = [[rng.randint(-128, 127) for _ in range(3)] for _ in range(3)]
+            u = _transform(G, g, G)
+            v = _transform(B_T, d, B_T)
+            prod = [[u[r][c] * v[r][c] for c in range(4)] for r in range(4)]
+            y = _transform(A_T, prod, A_T)
+            expected = [[4 * sum(d[i + k][j + l] * g[k][l]
+                                 for k in range(3) for l in range(3))
+                         for j in range(2)] for i in range(2)]
+            self.assertEqual(y, expected)
+